@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Benchmark memsee's heavy operations on synthetic dumps.
+
+    python bench.py [--sizes 10000,100000,...] [--only read,gc,...] [--workdir DIR]
+
+For each size, a dump is made with dumpgen (and kept in the work directory
+for next time), then each benchmark runs in its own Python process.  The
+peak RSS reported is of the timed step, not the setup before it, with how
+much the step added to the RSS.  memsee runs in a plain IPython shell, with
+no notebook.  The benchmarks share one database per size, which read
+makes, and gc changes, so gc goes last.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from dumpgen import DumpGenerator
+
+
+DEFAULT_SIZES = "10000,100000,1000000,10000000"
+
+BENCHMARKS = ['read', 'heap_graph', 'igraph', 'path', 'kids', 'ancestor_types', 'dominators', 'gc']
+
+
+def maxrss_mb(who=resource.RUSAGE_SELF):
+    """The lifetime peak RSS of this process, or of its finished children, in MB."""
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        # Bytes on macOS, kilobytes elsewhere.
+        peak /= 1024
+    return peak / 1024
+
+
+def proc_status_mb(field):
+    """A size in MB from /proc/self/status, like VmRSS, or None without /proc."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except IOError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Start measuring peak RSS from now.  Returns False if it can't be done.
+
+    On Linux, this resets VmHWM, so it's the peak since the reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        return False
+    return proc_status_mb("VmHWM") is not None
+
+
+class PeakRss(object):
+    """The peak RSS in the block, and how much it added to the RSS before.
+
+    Where the peak can't be reset, it's the process's peak, and what the
+    block added is over the peak before it.
+    """
+    def __init__(self):
+        self.peak_mb = self.added_mb = None
+
+    def __enter__(self):
+        self.resettable = reset_peak_rss()
+        if self.resettable:
+            self.baseline_mb = proc_status_mb("VmRSS")
+        else:
+            self.baseline_mb = maxrss_mb()
+        return self
+
+    def __exit__(self, *exc_info):
+        peak = proc_status_mb("VmHWM") if self.resettable else maxrss_mb()
+        # Children, like read's parsing processes, are only made by the step.
+        self.peak_mb = max(peak, maxrss_mb(resource.RUSAGE_CHILDREN))
+        self.added_mb = max(0, peak - self.baseline_mb)
+
+
+def make_app():
+    """A MemSeeApp in a headless IPython shell."""
+    from IPython.core.interactiveshell import InteractiveShell
+    from sql.magic import load_ipython_extension as sql_load_ipython_extension
+    import memsee
+
+    shell = InteractiveShell.instance()
+    sql_load_ipython_extension(shell)
+    app = memsee.MemSeeApp(shell=shell)
+    shell.register_magics(app)
+    return shell, app
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send what memsee prints to /dev/null."""
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def run_benchmark(name, db, dump):
+    """Run one benchmark in this process, returning its seconds and PeakRss."""
+    shell, app = make_app()
+    magic = shell.run_line_magic
+    with quiet():
+        if name == 'read':
+            for path in glob.glob(db) + glob.glob(db + "-*") + glob.glob(db + ".gen*"):
+                os.remove(path)
+            magic('create', db)
+        else:
+            magic('open', db)
+            if name == 'heap_graph':
+                app.invalidate_graph()
+            else:
+                # The others shouldn't pay for loading the graph.
+                app.heap_graph()
+            # dumpgen numbers each tree's objects together, so the root
+            # followed by the biggest gap has the biggest tree.
+            roots = sorted(row[0] for row in app.raw_connection.execute(
+                "select child from ref where parent = 0 and child != 0"
+            ))
+            gaps = [(after - before, before) for before, after in zip(roots, roots[1:] + [app.fetchint("select max(address) + 1 from obj")])]
+            root = max(gaps)[1]
+
+        with PeakRss() as peak:
+            start = time.time()
+            if name == 'read':
+                magic('read', dump)
+            elif name == 'heap_graph':
+                app.heap_graph()
+            elif name == 'igraph':
+                app.graph
+            elif name == 'path':
+                magic('path', '''from "type = 'str' and address / 16 % 100 = 0" to "address = 0" reversed limit 1000''')
+            elif name == 'kids':
+                magic('kids', '{} limit 100000'.format(root))
+            elif name == 'ancestor_types':
+                magic('ancestor_types', "type = 'str' and address / 16 % 100 = 0")
+            elif name == 'dominators':
+                magic('dominators', '')
+            elif name == 'gc':
+                magic('gc', '')
+            else:
+                raise ValueError("No benchmark named {}".format(name))
+            seconds = time.time() - start
+        return seconds, peak
+
+
+def run_child(name, db, dump):
+    """Run a benchmark in a new process, returning its results."""
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "--child", name, db, dump],
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark memsee on synthetic dumps.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated object counts")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma-separated benchmarks to run")
+    parser.add_argument("--workdir", default="bench-data", help="where dumps and databases go")
+    parser.add_argument("--gzip", action="store_true", help="read gzipped dumps")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", nargs=3, metavar=("NAME", "DB", "DUMP"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        seconds, peak = run_benchmark(*args.child)
+        print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak.peak_mb, 'added_rss_mb': peak.added_mb}))
+        return
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    names = args.only.split(",")
+    results = []
+    print("{:>10} {:<16} {:>10} {:>12} {:>12}".format("objects", "benchmark", "seconds", "peak RSS MB", "added MB"))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        dump = os.path.join(args.workdir, "dump-{}.json{}".format(size, ".gz" if args.gzip else ""))
+        if not os.path.exists(dump):
+            DumpGenerator(objects=size, surrogates=0.0001).write(dump)
+        db = os.path.join(args.workdir, "bench-{}.db".format(size))
+        for name in BENCHMARKS:
+            if name not in names:
+                continue
+            result = run_child(name, db, dump)
+            result.update(objects=size, benchmark=name)
+            results.append(result)
+            print("{objects:>10} {benchmark:<16} {seconds:>10.2f} {peak_rss_mb:>12.1f} {added_rss_mb:>12.1f}".format(**result))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
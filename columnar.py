@@ -0,0 +1,319 @@
+"""Generations as directories of NumPy columns, for analysis without SQL.
+
+A columnar generation is a directory with a file or two per column of obj
+and ref, all memory-mappable:
+
+    obj.address.npy             int64
+    obj.size.npy, .valid.npy    int64, and whether each value isn't null
+    obj.type.npy                int32 codes into obj.type.json, -1 for null
+    obj.repr.offsets.npy        int64 offsets into obj.repr.data.npy, which
+    obj.repr.data.npy           is UTF-8 bytes, and obj.repr.valid.npy
+    obj.repr.valid.npy
+    ref.parent.npy, ref.child.npy
+    meta.json                   row counts and column kinds
+
+`ColumnarWriter` writes them a batch of rows at a time, and `load` maps
+them back.
+
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+from pandas import Categorical, DataFrame, Series
+
+
+# The columns of each table, with how they are stored: "int" columns are
+# int64, nullable ones with a validity mask, "dict" columns are
+# dictionary-encoded strings, and "str" columns are UTF-8 with offsets.
+TABLES = {
+    'obj': [
+        ('address', 'int'),
+        ('type', 'dict'),
+        ('name', 'str'),
+        ('value', 'str'),
+        ('size', 'nullable int'),
+        ('len', 'nullable int'),
+        ('mark', 'nullable int'),
+        ('repr', 'str'),
+    ],
+    'ref': [
+        ('parent', 'int'),
+        ('child', 'int'),
+    ],
+}
+
+
+def _text(value):
+    """Column values as text, the way SQLite's text affinity stores them."""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if not isinstance(value, type(u"")):
+        return type(u"")(value)
+    return value
+
+
+class _ColumnWriter(object):
+    """Appends the values of one column to raw files, made into .npy at the end."""
+    def __init__(self, prefix, kind):
+        self.prefix = prefix
+        self.kind = kind
+        self.count = 0
+        self.parts = {}
+        # Every part gets a file, even if no values are added.
+        if kind == 'int':
+            self._append('', np.zeros(0, dtype=np.int64))
+        elif kind == 'nullable int':
+            self._append('', np.zeros(0, dtype=np.int64))
+            self._append('valid', np.zeros(0, dtype=bool))
+        elif kind == 'dict':
+            self.codes = {}
+            self._append('', np.zeros(0, dtype=np.int32))
+        else:
+            self.data_length = 0
+            # The offset before the first value.
+            self._append('offsets', np.zeros(1, dtype=np.int64))
+            self._append('valid', np.zeros(0, dtype=bool))
+            self._append('data', np.zeros(0, dtype=np.uint8))
+
+    def _append(self, part, array):
+        if part not in self.parts:
+            self.parts[part] = (open(self.prefix + "." + part + ".tmp", "wb"), array.dtype, [0])
+        f, _, length = self.parts[part]
+        f.write(array.tobytes())
+        length[0] += len(array)
+
+    def add(self, values):
+        self.count += len(values)
+        if self.kind == 'int':
+            self._append('', np.array(values, dtype=np.int64))
+        elif self.kind == 'nullable int':
+            valid = np.array([v is not None for v in values], dtype=bool)
+            self._append('', np.array([v if v is not None else 0 for v in values], dtype=np.int64))
+            self._append('valid', valid)
+        elif self.kind == 'dict':
+            codes = self.codes
+            self._append('', np.array(
+                [-1 if v is None else codes.setdefault(_text(v), len(codes)) for v in values],
+                dtype=np.int32,
+            ))
+        else:
+            texts = [_text(v) for v in values]
+            encoded = [t.encode('utf-8', 'surrogatepass') if t is not None else b"" for t in texts]
+            lengths = np.array([len(b) for b in encoded], dtype=np.int64)
+            self._append('offsets', self.data_length + np.cumsum(lengths))
+            self._append('valid', np.array([t is not None for t in texts], dtype=bool))
+            data = b"".join(encoded)
+            self._append('data', np.frombuffer(data, dtype=np.uint8))
+            self.data_length += len(data)
+
+    def close(self):
+        for part, (f, dtype, length) in self.parts.items():
+            f.close()
+            tmp = f.name
+            name = self.prefix + ("." + part if part else "") + ".npy"
+            if length[0]:
+                out = np.lib.format.open_memmap(name, mode='w+', dtype=dtype, shape=(length[0],))
+                out[:] = np.fromfile(tmp, dtype=dtype)
+                del out
+            else:
+                np.save(name, np.zeros(0, dtype=dtype))
+            os.remove(tmp)
+        if self.kind == 'dict':
+            categories = sorted(self.codes, key=self.codes.get)
+            with open(self.prefix + ".json", "w") as f:
+                json.dump(categories, f)
+
+
+class ColumnarWriter(object):
+    """Write obj and ref rows into a new columnar generation at `path`.
+
+    Rows are tuples in the order of TABLES.  Call `close` at the end.
+    """
+    def __init__(self, path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path = path
+        self.writers = dict(
+            (table, [(name, _ColumnWriter(os.path.join(path, table + "." + name), kind)) for name, kind in columns])
+            for table, columns in TABLES.items()
+        )
+
+    def add(self, table, rows):
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        for (name, writer), values in zip(self.writers[table], columns):
+            writer.add(values)
+
+    def close(self, **extra):
+        """Finish the files.  `extra` is stored in meta.json."""
+        meta = dict(extra)
+        meta['tables'] = {}
+        for table, writers in self.writers.items():
+            for name, writer in writers:
+                writer.close()
+            meta['tables'][table] = {
+                'rows': writers[0][1].count,
+                'columns': [[name, writer.kind] for name, writer in writers],
+            }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+def export_tables(conn, obj, ref, path, batch_size=100000):
+    """Write the `obj` and `ref` tables on sqlite3 `conn` to `path`.
+
+    Objects are written in address order.  Returns the number of rows of
+    each table.
+    """
+    writer = ColumnarWriter(path)
+    names = dict((table, ", ".join(name for name, kind in columns)) for table, columns in TABLES.items())
+    counts = {}
+    for table, query in (
+        ('obj', "select {} from {} order by address".format(names['obj'], obj)),
+        ('ref', "select {} from {}".format(names['ref'], ref)),
+    ):
+        cursor = conn.execute(query)
+        counts[table] = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            writer.add(table, rows)
+            counts[table] += len(rows)
+    writer.close(sorted=True)
+    return counts
+
+
+# The most bytes decode_strings copies into a fixed-width array at a time.
+DECODE_BYTES = 16 * 1024 * 1024
+
+
+def _decode_one(data, start, length):
+    return data[start:start + length].tobytes().decode('utf-8', 'surrogatepass')
+
+
+def decode_strings(offsets, data, valid):
+    """Decode a "str" column into an object array of text, None for nulls.
+
+    Strings are grouped by length, copied into fixed-width arrays padded to
+    at most twice their length, and decoded with np.char.decode.
+    """
+    values = np.empty(len(valid), dtype=object)
+    offsets = np.asarray(offsets)
+    data = np.asarray(data)
+    rows = np.flatnonzero(np.asarray(valid))
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    values[rows[lengths == 0]] = u""
+    # Each string's length, rounded up to a power of two.
+    widths = np.zeros(len(rows), dtype=np.int64)
+    nonempty = lengths > 0
+    widths[nonempty] = 2 ** np.ceil(np.log2(lengths[nonempty])).astype(np.int64)
+    for width in np.unique(widths[nonempty]).tolist():
+        group = np.flatnonzero(widths == width)
+        # Every window of `width` bytes in data, without copying.
+        windows = np.lib.stride_tricks.as_strided(
+            data, shape=(max(0, len(data) - width + 1), width), strides=data.strides * 2,
+        )
+        batch = max(1, DECODE_BYTES // width)
+        for first in range(0, len(group), batch):
+            chunk = group[first:first + batch]
+            # Strings in the last few bytes have no whole window.
+            fits = starts[chunk] < len(windows)
+            for i in chunk[~fits]:
+                values[rows[i]] = _decode_one(data, starts[i], lengths[i])
+            chunk = chunk[fits]
+            padded = windows[starts[chunk]]
+            padded[np.arange(width) >= lengths[chunk, None]] = 0
+            fixed = padded.view("S{}".format(width)).ravel()
+            if padded.max(initial=0) < 0x80:
+                # ASCII, which NumPy converts without calling Python.
+                values[rows[chunk]] = fixed.astype("U{}".format(width))
+            else:
+                values[rows[chunk]] = np.char.decode(fixed, 'utf-8', 'surrogatepass')
+    # Fixed-width bytes lose trailing NULs, so decode those again.
+    nonempty = np.flatnonzero(nonempty)
+    for i in nonempty[data[starts[nonempty] + lengths[nonempty] - 1] == 0]:
+        values[rows[i]] = _decode_one(data, starts[i], lengths[i])
+    return values
+
+
+class ColumnarGeneration(object):
+    """A columnar generation, memory-mapped from `path`.
+
+    column("obj", "size") is a NumPy array; frame("obj") a DataFrame.
+    """
+    def __init__(self, path, mmap=True):
+        self.path = path
+        self.mmap_mode = 'r' if mmap else None
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.kinds = dict(
+            ((table, name), kind)
+            for table, info in self.meta['tables'].items()
+            for name, kind in info['columns']
+        )
+
+    def __len__(self):
+        return self.meta['tables']['obj']['rows']
+
+    def _load(self, table, name, part=""):
+        filename = os.path.join(self.path, "{}.{}{}.npy".format(table, name, "." + part if part else ""))
+        try:
+            return np.load(filename, mmap_mode=self.mmap_mode)
+        except ValueError:
+            # Empty arrays can't be memory-mapped.
+            return np.load(filename)
+
+    def valid(self, table, name):
+        """Which values of a column aren't null."""
+        kind = self.kinds[(table, name)]
+        if kind == 'int':
+            return np.ones(self.meta['tables'][table]['rows'], dtype=bool)
+        if kind == 'dict':
+            return self._load(table, name) >= 0
+        return self._load(table, name, 'valid')
+
+    def column(self, table, name):
+        """The values of a column.
+
+        Integers are an int64 array (with 0 for nulls, see `valid`),
+        dictionary-encoded strings are a pandas Categorical, and other
+        strings are decoded into an object array, with None for nulls.
+        """
+        kind = self.kinds[(table, name)]
+        if kind in ('int', 'nullable int'):
+            return self._load(table, name)
+        if kind == 'dict':
+            with open(os.path.join(self.path, "{}.{}.json".format(table, name))) as f:
+                categories = json.load(f)
+            return Categorical.from_codes(np.asarray(self._load(table, name)), categories)
+        return decode_strings(
+            self._load(table, name, 'offsets'),
+            self._load(table, name, 'data'),
+            self._load(table, name, 'valid'),
+        )
+
+    def frame(self, table, columns=None):
+        """A DataFrame of some or all of a table's columns."""
+        if columns is None:
+            columns = [name for name, kind in self.meta['tables'][table]['columns']]
+        data = {}
+        for name in columns:
+            values = self.column(table, name)
+            if self.kinds[(table, name)] == 'nullable int':
+                values = Series(values).where(np.asarray(self.valid(table, name)))
+            data[name] = values
+        return DataFrame(data, columns=columns)
+
+
+def load(path, mmap=True):
+    """Open the columnar generation at `path`."""
+    return ColumnarGeneration(path, mmap)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Write synthetic meliae dumps, for trying memsee on heaps of any size.
+
+    python dumpgen.py OUTFILE [--objects N] [--fanout F] [--depth D] ...
+
+The heap is a forest: each root has a tree of objects below it, with
+containers referring to a random number of children, about `fanout` on
+average, down to `depth` levels.  A fraction `cycles` of the objects also
+refer back to an object written earlier, which makes shared objects and
+cycles.  Roots are never referred back to, so they stay top objects.  A
+fraction `surrogates` of strings have a broken surrogate in their value,
+as meliae can write (https://bugs.launchpad.net/meliae/+bug/876810),
+which isn't valid UTF-8.
+
+The same arguments always write the same dump.  Files ending in .gz are
+gzipped.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import gzip
+import json
+import random
+
+
+# Relative frequencies of types, by default.
+DEFAULT_TYPES = "dict:3,list:2,tuple:2,str:4,int:3,function:1,module:0.2,Settings:0.5"
+
+# Types that refer to other objects.
+CONTAINERS = set(['dict', 'list', 'tuple', 'module', 'Settings', 'function'])
+
+# Addresses of objects are spaced like real ones.
+BASE_ADDRESS = 0x7f0000000000
+ADDRESS_STEP = 16
+
+
+def parse_types(spec):
+    """Parse "dict:3,str:1" into a list of (type, weight)."""
+    types = []
+    for item in spec.split(","):
+        name, _, weight = item.partition(":")
+        types.append((name, float(weight or 1)))
+    return types
+
+
+class DumpGenerator(object):
+    """Makes the lines of a synthetic dump."""
+    def __init__(self, objects=10000, fanout=4.0, depth=12, cycles=0.01,
+                 surrogates=0.0, types=DEFAULT_TYPES, seed=0):
+        self.objects = objects
+        self.fanout = fanout
+        self.depth = depth
+        self.cycles = cycles
+        self.surrogates = surrogates
+        self.rng = random.Random(seed)
+        names, weights = zip(*parse_types(types))
+        self.type_names = names
+        total = sum(weights)
+        self.cum_weights = []
+        running = 0
+        for weight in weights:
+            running += weight
+            self.cum_weights.append(running / total)
+
+    def address(self, n):
+        return BASE_ADDRESS + n * ADDRESS_STEP
+
+    def pick_type(self):
+        x = self.rng.random()
+        for name, cum in zip(self.type_names, self.cum_weights):
+            if x < cum:
+                return name
+        return self.type_names[-1]
+
+    def num_children(self):
+        # Uniform from 0 to 2 * fanout, so fanout on average.
+        return self.rng.randint(0, int(round(2 * self.fanout)))
+
+    def objects_with_refs(self):
+        """Yield (number, type, [child numbers]) for every object, roots first."""
+        made = 0
+        pending = collections.deque()
+        roots = set()
+        while made < self.objects:
+            if not pending:
+                # A new tree.
+                pending.append((made, self.pick_type(), 0))
+                roots.add(made)
+                made += 1
+            num, type_, level = pending.popleft()
+            children = []
+            if type_ in CONTAINERS and level < self.depth:
+                for _ in range(self.num_children()):
+                    if made >= self.objects:
+                        break
+                    pending.append((made, self.pick_type(), level + 1))
+                    children.append(made)
+                    made += 1
+            if num and self.rng.random() < self.cycles:
+                back = self.rng.randrange(num)
+                if back not in roots:
+                    children.append(back)
+            yield num, type_, children
+        # Objects made at the end don't get children.
+        for num, type_, level in pending:
+            yield num, type_, []
+
+    def line(self, num, type_, children):
+        """The JSON line for an object, as bytes."""
+        data = collections.OrderedDict([
+            ('address', self.address(num)),
+            ('type', type_),
+            ('size', self.rng.randint(16, 256)),
+        ])
+        if type_ in ('str', 'unicode'):
+            value = "s{}".format(num)
+            data['len'] = len(value)
+            data['value'] = value
+        elif type_ == 'int':
+            data['value'] = num
+        elif type_ in ('function', 'module', 'type'):
+            data['name'] = "{}{}".format(type_[0], num)
+        else:
+            data['len'] = len(children)
+        data['refs'] = [self.address(child) for child in children]
+        line = (json.dumps(data) + "\n").encode("ascii")
+        if type_ == 'str' and self.surrogates and self.rng.random() < self.surrogates:
+            line = line.replace(b'"value": "', b'"value": "\xed\xa0', 1)
+        return line
+
+    def lines(self):
+        for num, type_, children in self.objects_with_refs():
+            yield self.line(num, type_, children)
+
+    def write(self, filename):
+        """Write the dump to `filename`, gzipped if it ends with .gz."""
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "wb") as f:
+            f.writelines(self.lines())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic meliae dump.")
+    parser.add_argument("filename", help="file to write, gzipped if it ends with .gz")
+    parser.add_argument("--objects", type=int, default=10000, help="number of objects")
+    parser.add_argument("--fanout", type=float, default=4.0, help="average references from a container")
+    parser.add_argument("--depth", type=int, default=12, help="deepest level of each tree")
+    parser.add_argument("--cycles", type=float, default=0.01, help="fraction of objects with a reference back")
+    parser.add_argument("--surrogates", type=float, default=0.0, help="fraction of strings with broken surrogates")
+    parser.add_argument("--types", default=DEFAULT_TYPES, help="type mix, like dict:3,str:1")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+    DumpGenerator(
+        objects=args.objects, fanout=args.fanout, depth=args.depth, cycles=args.cycles,
+        surrogates=args.surrogates, types=args.types, seed=args.seed,
+    ).write(args.filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""A generation's object graph, held as compact NumPy arrays."""
+
+import array
+import itertools
+import os
+
+import numpy as np
+
+
+def fetch_array(cursor, query, width=1, dtype=np.int64):
+    """Run `query`, returning its integer columns as an array.
+
+    With `width` 1 the result is a flat array, otherwise it has one row per
+    result row.
+
+    """
+    rows = cursor.execute(query)
+    if width == 1:
+        return np.fromiter((row[0] for row in rows), dtype)
+    flat = np.fromiter(itertools.chain.from_iterable(rows), dtype)
+    return flat.reshape(-1, width)
+
+
+def expand(indptr, indices, vertices):
+    """Return the concatenated neighbour lists of `vertices` in a CSR graph."""
+    starts = indptr[vertices]
+    counts = indptr[vertices + 1] - starts
+    total = counts.sum()
+    if not total:
+        return np.empty(0, dtype=indices.dtype)
+    # Shift each run of positions so that it starts at its vertex's offset.
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+
+def expand_from(indptr, indices, vertices):
+    """Like `expand`, but also return the vertex each neighbour came from."""
+    counts = indptr[vertices + 1] - indptr[vertices]
+    return expand(indptr, indices, vertices), np.repeat(vertices, counts)
+
+
+def to_csr(sources, targets, num_vertices):
+    """Build (indptr, indices) listing `targets` by `sources`."""
+    order = np.argsort(sources, kind='mergesort')
+    indptr = np.zeros(num_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_vertices), out=indptr[1:])
+    return indptr, targets[order]
+
+
+class HeapGraph(object):
+    """The references of a generation, as edges between dense vertex ids.
+
+    Vertex i is the object at `addresses[i]`.  Addresses are sorted, so
+    they translate to vertex ids by binary search.  Only references between
+    objects that exist are kept, like the joins the SQL code uses.
+
+    """
+    def __init__(self, addresses, parents, children):
+        self.addresses = addresses
+        self.parents = parents
+        self.children = children
+        self._csr = None
+        self._parent_csr = None
+
+    @classmethod
+    def from_db(cls, conn, obj='obj', ref='ref'):
+        """Load the graph from the `obj` and `ref` tables on sqlite3 `conn`."""
+        cursor = conn.cursor()
+        addresses = fetch_array(cursor, "select address from {} order by address".format(obj))
+        edges = fetch_array(cursor, "select parent, child from {}".format(ref), width=2)
+        parents, parent_found = cls.lookup(addresses, edges[:, 0])
+        children, child_found = cls.lookup(addresses, edges[:, 1])
+        del edges
+        keep = parent_found & child_found
+        id_type = np.int32 if len(addresses) < 2 ** 31 else np.int64
+        return cls(addresses, parents[keep].astype(id_type), children[keep].astype(id_type))
+
+    def save(self, prefix):
+        """Write the graph to .npy files named from `prefix`.
+
+        Edges are written sorted by parent, so the CSR index of a loaded
+        graph is cheap to rebuild.
+
+        """
+        order = np.argsort(self.parents, kind='mergesort')
+        edges = np.column_stack((self.parents[order], self.children[order]))
+        for part, data in (('edges', edges), ('vertices', self.addresses)):
+            path = "{}.{}.npy".format(prefix, part)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, data)
+            os.rename(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, prefix):
+        """Memory-map a graph written by `save`.  Raises IOError if there isn't one."""
+        arrays = []
+        for part in ('vertices', 'edges'):
+            path = "{}.{}.npy".format(prefix, part)
+            if not os.path.exists(path):
+                raise IOError("No cached graph at {}".format(path))
+            try:
+                arrays.append(np.load(path, mmap_mode='r'))
+            except ValueError:
+                # Empty arrays can't be memory-mapped.
+                arrays.append(np.load(path))
+        addresses, edges = arrays
+        return cls(addresses, edges[:, 0], edges[:, 1])
+
+    @staticmethod
+    def remove(prefix):
+        """Delete the files written by `save`, if there are any."""
+        for part in ('vertices', 'edges'):
+            try:
+                os.remove("{}.{}.npy".format(prefix, part))
+            except OSError:
+                pass
+
+    @staticmethod
+    def lookup(addresses, wanted):
+        """Map `wanted` addresses to vertex ids, and a mask of those found."""
+        ids = np.searchsorted(addresses, wanted)
+        ids[ids == len(addresses)] = 0
+        if len(addresses):
+            found = addresses[ids] == wanted
+        else:
+            found = np.zeros(len(wanted), dtype=bool)
+        return ids, found
+
+    def ids(self, addresses):
+        """Vertex ids for the `addresses` that are in the graph, in order."""
+        ids, found = self.lookup(self.addresses, np.asarray(addresses, dtype=np.int64))
+        return ids[found]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def edge_pairs(self, batch=1000000):
+        """Yield each edge as a (parent, child) tuple of ints.
+
+        Only `batch` edges at a time are made into Python ints, so a graph
+        can be built from a memory-mapped one without a list of every edge.
+
+        """
+        for start in range(0, len(self.parents), batch):
+            end = start + batch
+            for pair in zip(self.parents[start:end].tolist(), self.children[start:end].tolist()):
+                yield pair
+
+    @property
+    def csr(self):
+        """Children of each vertex, as (indptr, indices)."""
+        if self._csr is None:
+            self._csr = to_csr(self.parents, self.children, len(self))
+        return self._csr
+
+    @property
+    def parent_csr(self):
+        """Parents of each vertex, as (indptr, indices)."""
+        if self._parent_csr is None:
+            self._parent_csr = to_csr(self.children, self.parents, len(self))
+        return self._parent_csr
+
+    def mark_reachable(self, marks):
+        """Extend breadth-first depth marks through the graph.
+
+        `marks` holds a depth per vertex, or -1 for unmarked vertices.  The
+        vertices at the greatest depth are the frontier, so a walk that was
+        stopped after any level resumes where it left off.  Yields
+        (depth, newly marked ids) after each level has been marked.
+
+        """
+        indptr, indices = self.csr
+        depth = marks.max() if len(marks) else -1
+        if depth < 0:
+            return
+        frontier = np.flatnonzero(marks == depth)
+        while len(frontier):
+            kids = np.unique(expand(indptr, indices, frontier))
+            frontier = kids[marks[kids] < 0]
+            if not len(frontier):
+                break
+            depth += 1
+            marks[frontier] = depth
+            yield depth, frontier
+
+    def mark_ancestors(self, marks, stop=None, max_depth=None):
+        """Extend breadth-first depth marks back through referrers.
+
+        Like `mark_reachable`, but following references from child to
+        parent.  The referrers of vertices where `stop` is true aren't
+        followed, and no vertex is marked deeper than `max_depth`.
+
+        """
+        indptr, indices = self.parent_csr
+        depth = marks.max() if len(marks) else -1
+        if depth < 0:
+            return
+        frontier = np.flatnonzero(marks == depth)
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            if stop is not None:
+                frontier = frontier[~stop[frontier]]
+            parents = np.unique(expand(indptr, indices, frontier))
+            frontier = parents[marks[parents] < 0]
+            if not len(frontier):
+                break
+            depth += 1
+            marks[frontier] = depth
+            yield depth, frontier
+
+    def shortest_paths(self, sources, targets, reverse=False, limit=None, max_length=None):
+        """Find shortest paths from any of `sources` to each of `targets`.
+
+        Paths follow references from parent to child, or child to parent if
+        `reverse` is true.  Returns a list of vertex id arrays, shortest
+        first, at most `limit` of them, with at most `max_length` edges.
+
+        """
+        sources = np.unique(np.asarray(sources, dtype=np.int64))
+        targets = np.unique(np.asarray(targets, dtype=np.int64))
+        if not len(sources) or not len(targets):
+            return []
+        if len(sources) == 1 and len(targets) == 1:
+            path = self._bidirectional_path(sources[0], targets[0], reverse, max_length)
+            return [path] if path is not None else []
+
+        indptr, indices = self.parent_csr if reverse else self.csr
+        # pred is the vertex each vertex was reached from: -2 for sources,
+        # -1 for vertices not reached yet.
+        pred = np.full(len(self), -1, dtype=np.int64)
+        pred[sources] = -2
+        is_target = np.zeros(len(self), dtype=bool)
+        is_target[targets] = True
+
+        found = list(sources[is_target[sources]])
+        frontier = sources
+        depth = 0
+        while len(frontier) and (limit is None or len(found) < limit):
+            if max_length is not None and depth >= max_length:
+                break
+            neighbours, came_from = expand_from(indptr, indices, frontier)
+            new = pred[neighbours] == -1
+            frontier, first = np.unique(neighbours[new], return_index=True)
+            pred[frontier] = came_from[new][first]
+            found.extend(frontier[is_target[frontier]])
+            depth += 1
+
+        paths = []
+        for target in found[:limit]:
+            path = [target]
+            while pred[path[-1]] >= 0:
+                path.append(pred[path[-1]])
+            paths.append(np.array(path[::-1], dtype=np.int64))
+        return paths
+
+    def _bidirectional_path(self, source, target, reverse=False, max_length=None):
+        """A shortest path between two vertices, searching from both ends."""
+        if source == target:
+            return np.array([source], dtype=np.int64)
+        forward = self.parent_csr if reverse else self.csr
+        backward = self.csr if reverse else self.parent_csr
+        # For each side: the CSR to walk, the vertex each vertex was
+        # reached from, its distance, and the frontier.
+        sides = []
+        for start, csr in ((source, forward), (target, backward)):
+            pred = np.full(len(self), -1, dtype=np.int64)
+            dist = np.full(len(self), -1, dtype=np.int64)
+            pred[start] = -2
+            dist[start] = 0
+            sides.append([csr, pred, dist, np.array([start], dtype=np.int64)])
+
+        length = 0
+        while len(sides[0][3]) and len(sides[1][3]):
+            if max_length is not None and length >= max_length:
+                return None
+            # Grow the side with the smaller frontier by one level.
+            this, other = sides if len(sides[0][3]) <= len(sides[1][3]) else sides[::-1]
+            (indptr, indices), pred, dist, frontier = this
+            neighbours, came_from = expand_from(indptr, indices, frontier)
+            new = pred[neighbours] == -1
+            frontier, first = np.unique(neighbours[new], return_index=True)
+            pred[frontier] = came_from[new][first]
+            dist[frontier] = dist[came_from[new][first]] + 1
+            this[3] = frontier
+            length += 1
+
+            met = frontier[other[2][frontier] >= 0]
+            if len(met):
+                middle = met[np.argmin(other[2][met])]
+                if max_length is not None and dist[middle] + other[2][middle] > max_length:
+                    return None
+                halves = []
+                for side in sides:
+                    half = [middle]
+                    while side[1][half[-1]] >= 0:
+                        half.append(side[1][half[-1]])
+                    halves.append(half)
+                return np.array(halves[0][::-1] + halves[1][1:], dtype=np.int64)
+        return None
+
+
+def _int_array(values):
+    """A compact array.array of ints, cheap to index from Python loops."""
+    result = array.array('q')
+    result.frombytes(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return result
+
+
+def dominators(indptr, indices, root):
+    """Find immediate dominators with the Lengauer-Tarjan algorithm.
+
+    The graph is in CSR form.  Returns (idom, order): `idom` is the immediate
+    dominator of each vertex, -1 for `root` and unreachable vertices, and
+    `order` is the reachable vertices in depth-first preorder.
+
+    The work is done in preorder numbers over flat integer arrays, with
+    path compression, so there are no per-vertex Python objects.
+
+    """
+    num_vertices = len(indptr) - 1
+    ptr = _int_array(indptr)
+    adj = _int_array(indices)
+
+    # Depth-first numbering.  A vertex is numbered when it's popped, so its
+    # tree parent is the vertex that pushed it last, kept in `pushed_by`:
+    # that push is the one popped first.
+    number = array.array('q', [-1]) * num_vertices
+    pushed_by = array.array('q', [-1]) * num_vertices
+    order = array.array('q')
+    dfs_parent = array.array('q')
+    stack = array.array('q', [root])
+    while stack:
+        v = stack.pop()
+        if number[v] >= 0:
+            continue
+        n = number[v] = len(order)
+        order.append(v)
+        dfs_parent.append(pushed_by[v])
+        for i in range(ptr[v], ptr[v + 1]):
+            w = adj[i]
+            if number[w] < 0:
+                pushed_by[w] = n
+                stack.append(w)
+
+    # Predecessor lists, in preorder numbers, of the reachable vertices.
+    order_np = np.frombuffer(order.tobytes(), dtype=np.int64)
+    number_np = np.frombuffer(number.tobytes(), dtype=np.int64)
+    reached = len(order)
+    sources = np.repeat(np.arange(num_vertices), np.diff(indptr))
+    src = number_np[sources]
+    dst = number_np[indices]
+    keep = (src >= 0) & (dst >= 0)
+    pred_ptr, pred = to_csr(dst[keep], src[keep], reached)
+    pred_ptr = _int_array(pred_ptr)
+    pred = _int_array(pred)
+
+    semi = array.array('q', range(reached))
+    idom = array.array('q', [-1]) * reached
+    samedom = array.array('q', [-1]) * reached
+    ancestor = array.array('q', [-1]) * reached
+    best = array.array('q', range(reached))
+    bucket_head = array.array('q', [-1]) * reached
+    bucket_next = array.array('q', [-1]) * reached
+
+    def eval_(v):
+        """The ancestor of `v` with the lowest semidominator."""
+        path = []
+        while ancestor[ancestor[v]] >= 0:
+            path.append(v)
+            v = ancestor[v]
+        for x in reversed(path):
+            a = ancestor[x]
+            if semi[best[a]] < semi[best[x]]:
+                best[x] = best[a]
+            ancestor[x] = ancestor[a]
+        return best[path[0]] if path else best[v]
+
+    for n in range(reached - 1, 0, -1):
+        p = dfs_parent[n]
+        s = p
+        for i in range(pred_ptr[n], pred_ptr[n + 1]):
+            v = pred[i]
+            if v <= n:
+                candidate = v
+            else:
+                candidate = semi[eval_(v)]
+            if candidate < s:
+                s = candidate
+        semi[n] = s
+        bucket_next[n] = bucket_head[s]
+        bucket_head[s] = n
+        ancestor[n] = p
+
+        v = bucket_head[p]
+        while v >= 0:
+            y = eval_(v)
+            if semi[y] == semi[v]:
+                idom[v] = p
+            else:
+                samedom[v] = y
+            v = bucket_next[v]
+        bucket_head[p] = -1
+
+    for n in range(1, reached):
+        if samedom[n] >= 0:
+            idom[n] = idom[samedom[n]]
+
+    # Back from preorder numbers to vertex ids.
+    idom_np = np.frombuffer(idom.tobytes(), dtype=np.int64)
+    result = np.full(num_vertices, -1, dtype=np.int64)
+    result[order_np[1:]] = order_np[idom_np[1:]]
+    return result, order_np
+
+
+def retained_sizes(idom, order, sizes):
+    """Total size of each vertex and everything it dominates.
+
+    `idom` and `order` are as returned by `dominators`.  Vertices that
+    aren't reachable retain nothing.
+
+    """
+    retained = np.zeros(len(sizes), dtype=np.int64)
+    retained[order] = sizes[order]
+    totals = retained.tolist()
+    parents = idom.tolist()
+    # Every vertex comes after its dominator in preorder.
+    for v in order[:0:-1].tolist():
+        totals[parents[v]] += totals[v]
+    return np.array(totals, dtype=np.int64)
@@ -0,0 +1,132 @@
+"""The history of displayed results, kept within a memory budget."""
+
+import collections
+
+from pandas import DataFrame
+
+
+def quote(name):
+    """Quote `name` as an SQL identifier."""
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+class ResultHistory(object):
+    """A list of result DataFrames, numbered from 0, that can all be looked up.
+
+    The most recently used results are kept in memory, up to `budget` bytes.
+    Older ones are spilled to temp tables on the sqlite3 connection returned
+    by `get_connection`, and read back when they are asked for again.
+
+    """
+    TABLE = "memsee_result_{}"
+    COLUMN_TABLE = "memsee_col_{}_{}"
+
+    def __init__(self, get_connection, budget):
+        self.get_connection = get_connection
+        self.budget = budget
+        # Result number -> (DataFrame, size), least recently used first.
+        self.loaded = collections.OrderedDict()
+        # Result number -> column names, for the results in temp tables.
+        self.spilled = {}
+        # (result number, column) -> temp table of the column's values.
+        self.column_tables = {}
+        self.count = 0
+        self.loaded_bytes = 0
+
+    def __len__(self):
+        return self.count
+
+    def next_number(self):
+        """The number the next result appended will have."""
+        return self.count
+
+    def append(self, results):
+        """Add a DataFrame to the history, returning its number."""
+        num = self.count
+        self.count += 1
+        self._load(num, results)
+        return num
+
+    def __getitem__(self, num):
+        """The DataFrame for result `num`.  Raises IndexError if there isn't one."""
+        if not 0 <= num < self.count:
+            raise IndexError("No result #{}".format(num))
+        if num in self.loaded:
+            self.loaded[num] = self.loaded.pop(num)
+            return self.loaded[num][0]
+        results = self._unspill(num)
+        self._load(num, results)
+        return results
+
+    def column_table(self, num, column, convert=None):
+        """The name of an indexed temp table of the values in a result column.
+
+        The table has one column, `value`, and is made the first time it's
+        asked for.  `convert` is applied to each value first; values it
+        turns into None are left out.
+
+        """
+        key = (num, column)
+        if key not in self.column_tables:
+            values = self[num][column]
+            if convert is not None:
+                values = (convert(value) for value in values)
+            table = self.COLUMN_TABLE.format(num, column)
+            conn = self.get_connection()
+            conn.execute("drop table if exists temp.{}".format(table))
+            conn.execute("create temp table {} (value)".format(table))
+            conn.executemany(
+                "insert into temp.{} values (?)".format(table),
+                ((value,) for value in values if value is not None),
+            )
+            conn.execute("create index temp.{0}_value on {0} (value)".format(table))
+            conn.commit()
+            self.column_tables[key] = "temp." + table
+        return self.column_tables[key]
+
+    def clear(self):
+        """Forget every result, dropping the temp tables made for them."""
+        if self.spilled or self.column_tables:
+            conn = self.get_connection()
+            for num in self.spilled:
+                conn.execute("drop table if exists temp.{}".format(self.TABLE.format(num)))
+            for table in self.column_tables.values():
+                conn.execute("drop table if exists {}".format(table))
+            conn.commit()
+        self.loaded.clear()
+        self.spilled.clear()
+        self.column_tables.clear()
+        self.count = 0
+        self.loaded_bytes = 0
+
+    def _load(self, num, results):
+        size = int(results.memory_usage(index=True, deep=True).sum())
+        self.loaded[num] = (results, size)
+        self.loaded_bytes += size
+        # Always keep the newest result, even if it's over budget by itself.
+        while self.loaded_bytes > self.budget and len(self.loaded) > 1:
+            old_num, (old_results, old_size) = self.loaded.popitem(last=False)
+            if old_num not in self.spilled:
+                self._spill(old_num, old_results)
+            self.loaded_bytes -= old_size
+
+    def _spill(self, num, results):
+        conn = self.get_connection()
+        table = self.TABLE.format(num)
+        columns = [results.index.name or "index"] + list(results.columns)
+        conn.execute("drop table if exists temp.{}".format(table))
+        conn.execute("create temp table {} ({})".format(table, ", ".join(quote(c) for c in columns)))
+        conn.executemany(
+            "insert into temp.{} values ({})".format(table, ", ".join("?" * len(columns))),
+            results.itertuples(index=True, name=None),
+        )
+        conn.commit()
+        self.spilled[num] = columns
+
+    def _unspill(self, num):
+        columns = self.spilled[num]
+        rows = self.get_connection().execute(
+            "select * from temp.{} order by rowid".format(self.TABLE.format(num))
+        )
+        results = DataFrame.from_records(list(rows), columns=columns)
+        return results.set_index(columns[0])
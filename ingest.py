@@ -0,0 +1,272 @@
+"""Parsing of meliae dump files, and bulk loading into a generation's tables."""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import re
+import time
+import ujson
+
+import numpy as np
+
+
+# Number of lines handed to a parsing worker at a time.
+CHUNK_LINES = 10000
+
+
+def parse_line(line):
+    """Parse one line of meliae JSON into a dict, with a derived 'repr'."""
+    try:
+        objdata = ujson.loads(line)
+    except ValueError:
+        # https://bugs.launchpad.net/meliae/+bug/876810
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        objdata = ujson.loads(re.sub(r'"value": "(\\"|[^"])*"', '"value": "SURROGATE ERROR REMOVED"', line))
+
+    try:
+        if objdata['type'] in ('function', 'type', 'module'):
+            objdata['repr'] = objdata.get('name', objdata.get('value', objdata['type']))
+        elif objdata['type'] in ('int', 'str', 'unicode'):
+            objdata['repr'] = repr(objdata['value'])
+        else:
+            objdata['repr'] = objdata['type']
+    except:
+        print(objdata)
+        objdata['repr'] = objdata['type']
+    return objdata
+
+
+# Rows parsed from a chunk of lines, with per-type totals:
+# types maps a type name to [count, bytes, len, refs].  length is the size
+# of the lines in the file.  addresses are the objects' addresses, and
+# children the sorted distinct addresses they refer to.
+ParsedChunk = collections.namedtuple('ParsedChunk', 'obj_rows ref_rows nbytes types length addresses children')
+
+
+def parse_chunk(lines):
+    """Parse a list of lines into a ParsedChunk."""
+    obj_rows = []
+    ref_rows = []
+    nbytes = 0
+    types = {}
+    length = 0
+    for line in lines:
+        length += len(line)
+        objdata = parse_line(line)
+        address = objdata['address']
+        obj_rows.append((
+            address,
+            objdata['type'],
+            objdata.get('name'),
+            objdata.get('value'),
+            objdata['size'],
+            objdata.get('len'),
+            objdata['repr'],
+        ))
+        nbytes += objdata['size']
+        ref_rows.extend((address, child) for child in objdata['refs'])
+
+        totals = types.get(objdata['type'])
+        if totals is None:
+            totals = types[objdata['type']] = [0, 0, 0, 0]
+        totals[0] += 1
+        totals[1] += objdata['size']
+        totals[2] += objdata.get('len') or 0
+        totals[3] += len(objdata['refs'])
+    addresses = np.array([row[0] for row in obj_rows], dtype=np.int64)
+    children = np.unique(np.array([row[1] for row in ref_rows], dtype=np.int64))
+    return ParsedChunk(obj_rows, ref_rows, nbytes, types, length, addresses, children)
+
+
+def read_chunks(data, chunk_lines=CHUNK_LINES):
+    """Group the lines of `data` into lists of `chunk_lines` lines."""
+    chunk = []
+    for line in data:
+        chunk.append(line)
+        if len(chunk) >= chunk_lines:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_chunks(data, workers=1, chunk_lines=CHUNK_LINES, context=multiprocessing):
+    """Parse the lines of `data`, yielding `parse_chunk` results in file order.
+
+    With more than one worker, chunks are parsed by a process pool, made
+    by `context`, the multiprocessing module or one of its contexts.  At most
+    two chunks per worker are in flight, so a slow consumer doesn't make the
+    whole file pile up in memory.
+
+    """
+    chunks = read_chunks(data, chunk_lines)
+    if workers <= 1:
+        for chunk in chunks:
+            yield parse_chunk(chunk)
+        return
+
+    pool = context.Pool(workers)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(parse_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class BulkLoader(object):
+    """Batch obj and ref rows into large `executemany` calls.
+
+    Rows are written with the raw sqlite3 connection, and committed every
+    `batch_size` rows.  `checkpoint` is called with a cursor and the loader
+    just before each commit, so it can record progress in the same
+    transaction.  `progress` is called with the loader after each commit.
+
+    `offset` is how far into the data file the committed rows go.
+
+    With `compact`, objects go into a compact generation's obj_data, with
+    their types and reprs interned in the types and reprs tables.  They
+    are staged in a temp table, so interning is done by SQLite a batch at
+    a time, rather than with every repr kept in memory here.
+
+    The addresses of objects, and of objects something refers to, are kept
+    as arrays, so the objects nothing refers to can be found at the end.
+
+    """
+    OBJ_INSERT = (
+        "insert into obj (address, type, name, value, size, len, repr) "
+        "values (?, ?, ?, ?, ?, ?, ?)"
+    )
+    REF_INSERT = "insert into ref (parent, child) values (?, ?)"
+
+    COMPACT_STAGING = [
+        "create temp table if not exists load_obj (address int, type text, name text, value text, size int, len int, repr text)",
+        "delete from temp.load_obj",
+    ]
+    COMPACT_OBJ_INSERT = (
+        "insert into temp.load_obj (address, type, name, value, size, len, repr) "
+        "values (?, ?, ?, ?, ?, ?, ?)"
+    )
+    COMPACT_INTERN = [
+        "insert or ignore into types (name) select distinct type from temp.load_obj where type is not null",
+        "insert or ignore into reprs (repr) select distinct repr from temp.load_obj where repr is not null",
+        """insert into obj_data (address, type_id, name, value, size, len, repr_id)
+           select l.address, types.id, l.name, l.value, l.size, l.len, reprs.id
+             from temp.load_obj l
+                  left join types on types.name = l.type
+                  left join reprs on reprs.repr = l.repr""",
+        "delete from temp.load_obj",
+    ]
+
+    def __init__(self, conn, batch_size=100000, progress=None, checkpoint=None, compact=False):
+        self.conn = conn
+        self.compact = compact
+        self.batch_size = batch_size
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.obj_rows = []
+        self.ref_rows = []
+        self.objs = self.refs = self.bytes = 0
+        self.types = {}
+        self.offset = self.pending_length = 0
+        self.start = time.time()
+        self.start_rows = 0
+        self.addresses = []
+        # Sorted distinct children, and more arrays of them to merge in.
+        self.children = np.empty(0, dtype=np.int64)
+        self.new_children = []
+        self.num_new_children = 0
+        if compact:
+            for stmt in self.COMPACT_STAGING:
+                conn.execute(stmt)
+
+    def resume(self, objs, refs, bytes, types, offset, addresses, children):
+        """Carry on from totals saved by an earlier load, and the addresses
+        and children it loaded."""
+        self.addresses = [addresses]
+        self.children = np.unique(children)
+        self.objs = objs
+        self.refs = refs
+        self.bytes = bytes
+        self.types = types
+        self.offset = offset
+        self.start_rows = objs + refs
+
+    def add(self, chunk):
+        """Queue the rows of a ParsedChunk."""
+        self.obj_rows.extend(chunk.obj_rows)
+        self.ref_rows.extend(chunk.ref_rows)
+        self.bytes += chunk.nbytes
+        self.pending_length += chunk.length
+        self.addresses.append(chunk.addresses)
+        self.new_children.append(chunk.children)
+        self.num_new_children += len(chunk.children)
+        # Merging when the new ones outgrow the merged ones keeps the
+        # sorting to O(n log n) overall.
+        if self.num_new_children > max(len(self.children), 1000000):
+            self.merge_children()
+        for type_, chunk_totals in chunk.types.items():
+            totals = self.types.setdefault(type_, [0, 0, 0, 0])
+            for i, value in enumerate(chunk_totals):
+                totals[i] += value
+        if len(self.obj_rows) + len(self.ref_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write and commit the queued rows."""
+        cursor = self.conn.cursor()
+        if self.compact:
+            cursor.executemany(self.COMPACT_OBJ_INSERT, self.obj_rows)
+            for stmt in self.COMPACT_INTERN:
+                cursor.execute(stmt)
+        else:
+            cursor.executemany(self.OBJ_INSERT, self.obj_rows)
+        cursor.executemany(self.REF_INSERT, self.ref_rows)
+        self.objs += len(self.obj_rows)
+        self.refs += len(self.ref_rows)
+        self.offset += self.pending_length
+        if self.checkpoint:
+            self.checkpoint(cursor, self)
+        self.conn.commit()
+        self.obj_rows = []
+        self.ref_rows = []
+        self.pending_length = 0
+        if self.progress:
+            self.progress(self)
+
+    def merge_children(self):
+        if self.new_children:
+            self.children = np.unique(np.concatenate([self.children] + self.new_children))
+            self.new_children = []
+            self.num_new_children = 0
+
+    def roots(self, extra=()):
+        """The addresses loaded, and in `extra`, that nothing refers to."""
+        self.merge_children()
+        addresses = np.concatenate(self.addresses + [np.asarray(extra, dtype=np.int64)])
+        return np.setdiff1d(addresses, self.children)
+
+    def finish(self):
+        """Write any remaining rows, and return the load totals."""
+        if self.obj_rows or self.ref_rows:
+            self.flush()
+        return {'objs': self.objs, 'refs': self.refs, 'bytes': self.bytes, 'types': self.types}
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rows_per_sec(self):
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0
+        return (self.objs + self.refs - self.start_rows) / elapsed
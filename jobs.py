@@ -0,0 +1,118 @@
+"""Reads of data files in background threads, so the kernel stays free."""
+
+from __future__ import division
+
+import collections
+import multiprocessing
+import threading
+import time
+import traceback
+
+
+def pool_context():
+    """A multiprocessing context for starting process pools from a job's thread.
+
+    Forking copies the locks other threads hold, still held, into the new
+    process, so the processes come from a fork server, or are spawned.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class JobCancelled(Exception):
+    """Raised in a job's thread when the job has been cancelled."""
+
+
+class ReadJob(object):
+    """A data file read into generation `gen` by `work(job)`, in a thread.
+
+    `work` reports progress with `log` and `update`.  The job's state is
+    'running' until `work` returns, then 'done', 'cancelled' or 'failed'.
+    The rest of the read is done by the main thread, which then sets
+    `finished`.
+    """
+    def __init__(self, num, gen, filename, work):
+        self.num = num
+        self.gen = gen
+        self.filename = filename
+        self.work = work
+        self.state = 'running'
+        self.message = ""
+        self.rows = 0
+        self.rows_per_sec = 0.0
+        # How far into the file the read is, from 0 to 1, and where it
+        # started, for the ETA.
+        self.fraction = None
+        self.start_fraction = None
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.finished = False
+        self.started = time.time()
+        self.ended = None
+        self.thread = threading.Thread(target=self._run, name="memsee read {}".format(num))
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.result = self.work(self)
+        except JobCancelled:
+            self.state = 'cancelled'
+        except BaseException:
+            self.error = traceback.format_exc()
+            self.state = 'failed'
+        else:
+            self.state = 'done'
+        self.ended = time.time()
+
+    def log(self, message):
+        self.message = message
+
+    def update(self, rows, rows_per_sec, fraction):
+        """Record progress, from the job's thread.
+
+        Raises JobCancelled if the job has been cancelled, so the read
+        stops at a batch it has committed.
+        """
+        self.rows = rows
+        self.rows_per_sec = rows_per_sec
+        self.fraction = fraction
+        if self.start_fraction is None:
+            self.start_fraction = fraction
+        if self.cancelled:
+            raise JobCancelled()
+
+    @property
+    def running(self):
+        return self.state == 'running'
+
+    @property
+    def elapsed(self):
+        return (self.ended or time.time()) - self.started
+
+    @property
+    def eta(self):
+        """Seconds until the file is all read, at the rate so far, or None."""
+        if not self.running or self.fraction is None or self.fraction <= self.start_fraction:
+            return None
+        return self.elapsed * (1 - self.fraction) / (self.fraction - self.start_fraction)
+
+    def row(self):
+        """A row for the jobs table."""
+        eta = self.eta
+        return collections.OrderedDict([
+            ('job', self.num),
+            ('gen', self.gen),
+            ('file', self.filename),
+            ('state', self.state),
+            ('rows', self.rows),
+            ('rows_per_sec', int(self.rows_per_sec)),
+            ('done', None if self.fraction is None else "{:.0%}".format(self.fraction)),
+            ('eta', None if eta is None else "{:.0f}s".format(eta)),
+            ('elapsed', "{:.0f}s".format(self.elapsed)),
+            ('message', self.message),
+        ])
@@ -5,27 +5,39 @@ from __future__ import print_function
 from builtins import str
 from builtins import range
 from builtins import object
+import collections
+import contextlib
 import functools
 import gzip
+import json
 import igraph
 import math
+import multiprocessing
+import numpy as np
 import os
 import qgrid
 import re
 import shlex
-import shutil
 import sqlite3
 import sys
 import time
-import ujson
 
+import columnar
 from grid import GridWriter
+import heapgraph
+from heapgraph import HeapGraph, fetch_array
+from history import ResultHistory
+from ingest import BulkLoader, parse_chunks
+from jobs import ReadJob, pool_context
+from profiling import FULL_SCAN_RE, Profiler, profiled
+from query import QueryCompiler
+from snapshots import SnapshotStore
 from IPython.core.magic import (
     Magics, magics_class, line_magic,
     cell_magic, line_cell_magic
 )
-from IPython.utils.traitlets import Bool
-from pandas import Series
+from IPython.utils.traitlets import Bool, CaselessStrEnum, Dict, Int, List
+from pandas import Categorical, DataFrame, Series
 from sql.connection import Connection
 from sql.magic import SqlMagic, load_ipython_extension as sql_load_ipython_extension
 from sql.run import ResultSet
@@ -76,12 +88,36 @@ def need_db(fn):
     """Decorator for command handlers that need an open database."""
     @functools.wraps(fn)
     def _dec(self, *args, **kwargs):
-        if not Connection.get(None):
+        if not self.has_db():
             print("Need an open database")
             return
         return fn(self, *args, **kwargs)
     return _dec
 
+def bulk_write(fn):
+    """Decorator for methods that write a lot, to run them with the load PRAGMAs."""
+    @functools.wraps(fn)
+    def _dec(self, *args, **kwargs):
+        with self.pragma_profile('load'):
+            return fn(self, *args, **kwargs)
+    return _dec
+
+def set_pragmas(conn, schemas, pragmas):
+    """Set `pragmas`, a dict, on each of `schemas` of sqlite3 `conn`."""
+    for schema in schemas:
+        # In name order, the same every time.
+        for name in sorted(pragmas):
+            conn.execute("pragma {}.{} = {}".format(schema, name, pragmas[name])).fetchall()
+
+def remove_database(path):
+    """Remove a database file, with any journal or WAL files it left.
+
+    A new database of the same name would pick up a stale WAL.
+    """
+    for suffix in ("", "-journal", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
 def handle_errors(fn):
     """Decorator for command handlers that accept user SQL, to handle errors."""
     @functools.wraps(fn)
@@ -104,27 +140,256 @@ class MemSeeApp(SqlMagic):
         "create table env (name text, value text);",
     ]
 
-    # Schema for each generation, each is its own set of tables and indexes.
+    # Schema for each generation.  Each generation is its own database file,
+    # attached as schema gN.
     GEN_SCHEMA = [
-        "create table obj (address int primary key, type text, name text, value text, size int, len int, mark int, repr text);",
-        "create index size{gen} on obj (size);",
-        "create index type{gen} on obj (type);",
-        "create index name{gen} on obj (name);",
-        "create index value{gen} on obj (value);",
-        "create index mark{gen} on obj (mark);",
-        "create index repr{gen} on obj (repr);",
-
-        "create table ref (parent int, child int);",
-        "create index child{gen} on ref (child);",
-        "create index parent{gen} on ref (parent);",
+        "create table {schema}.obj (address int primary key, type text, name text, value text, size int, len int, mark int, repr text);",
+        "create table {schema}.ref (parent int, child int);",
+    ]
+
+    # Indexes for each generation, created once its data has been loaded.
+    GEN_INDEXES = [
+        "create index if not exists {schema}.size on obj (size);",
+        "create index if not exists {schema}.type on obj (type);",
+        "create index if not exists {schema}.name on obj (name);",
+        "create index if not exists {schema}.value on obj (value);",
+        "create index if not exists {schema}.mark on obj (mark);",
+        "create index if not exists {schema}.repr on obj (repr);",
+        "create index if not exists {schema}.child on ref (child);",
+        "create index if not exists {schema}.parent on ref (parent);",
+    ]
+
+    # The compact schema for a generation, used instead when compact_schema
+    # is on.  Type names and reprs are interned in dictionary tables, and
+    # objects are kept by address in obj_data, without a rowid.  obj is a
+    # view with the columns of the plain schema's table, so queries work the
+    # same, and its triggers turn changes to it into changes to obj_data.
+    COMPACT_GEN_SCHEMA = [
+        "create table {schema}.types (id integer primary key, name text unique);",
+        "create table {schema}.reprs (id integer primary key, repr text unique);",
+        "create table {schema}.obj_data (address int primary key, type_id int, name text, value text, size int, len int, mark int, repr_id int) without rowid;",
+        "create table {schema}.ref (parent int, child int);",
+        """create view {schema}.obj as
+            SELECT obj_data.address, types.name AS type, obj_data.name, obj_data.value,
+                   obj_data.size, obj_data.len, obj_data.mark, reprs.repr
+              FROM obj_data
+                   LEFT JOIN types ON types.id = obj_data.type_id
+                   LEFT JOIN reprs ON reprs.id = obj_data.repr_id;""",
+        # Not INSERT OR IGNORE, which an INSERT OR REPLACE into obj would
+        # turn into a replace, with a new id.
+        """create trigger {schema}.obj_insert INSTEAD OF INSERT ON obj BEGIN
+            INSERT INTO types (name) SELECT new.type
+             WHERE new.type IS NOT NULL AND NOT EXISTS (SELECT 1 FROM types WHERE name = new.type);
+            INSERT INTO reprs (repr) SELECT new.repr
+             WHERE new.repr IS NOT NULL AND NOT EXISTS (SELECT 1 FROM reprs WHERE repr = new.repr);
+            INSERT INTO obj_data (address, type_id, name, value, size, len, mark, repr_id)
+                VALUES (new.address, (SELECT id FROM types WHERE name = new.type), new.name, new.value,
+                        new.size, new.len, new.mark, (SELECT id FROM reprs WHERE repr = new.repr));
+        END;""",
+        """create trigger {schema}.obj_update INSTEAD OF UPDATE ON obj BEGIN
+            INSERT INTO types (name) SELECT new.type
+             WHERE new.type IS NOT NULL AND NOT EXISTS (SELECT 1 FROM types WHERE name = new.type);
+            INSERT INTO reprs (repr) SELECT new.repr
+             WHERE new.repr IS NOT NULL AND NOT EXISTS (SELECT 1 FROM reprs WHERE repr = new.repr);
+            UPDATE obj_data
+               SET address = new.address,
+                   type_id = (SELECT id FROM types WHERE name = new.type),
+                   name = new.name,
+                   value = new.value,
+                   size = new.size,
+                   len = new.len,
+                   mark = new.mark,
+                   repr_id = (SELECT id FROM reprs WHERE repr = new.repr)
+             WHERE address = old.address;
+        END;""",
+        """create trigger {schema}.obj_delete INSTEAD OF DELETE ON obj BEGIN
+            DELETE FROM obj_data WHERE address = old.address;
+        END;""",
+    ]
+
+    # Indexes for a compact generation.  Most objects have no name, value
+    # or mark, so those indexes leave out nulls: a query comparing the
+    # column to a value can still use them.  ref's indexes cover following
+    # references either way without reading the table.
+    COMPACT_GEN_INDEXES = [
+        "create index if not exists {schema}.size on obj_data (size);",
+        "create index if not exists {schema}.type on obj_data (type_id);",
+        "create index if not exists {schema}.name on obj_data (name) where name is not null;",
+        "create index if not exists {schema}.value on obj_data (value) where value is not null;",
+        "create index if not exists {schema}.mark on obj_data (mark) where mark is not null;",
+        "create index if not exists {schema}.repr on obj_data (repr_id);",
+        "create index if not exists {schema}.child_parent on ref (child, parent);",
+        "create index if not exists {schema}.parent_child on ref (parent, child);",
+    ]
+
+    # The name and table of an index statement.  The obj indexes are named
+    # for the column of obj they are on, in both schemas.
+    INDEX_RE = re.compile(r"\{schema\}\.(\w+) on (\w+) ")
+
+    # In a query, the obj columns indexes are made for, and obj tables,
+    # qualified with a generation's schema or not.  Only columns in the
+    # clauses that filter, join or sort count, and not in string literals.
+    INDEXED_COLUMN_RE = re.compile(r"\b(size|type|name|value|mark|repr)\b", re.IGNORECASE)
+    STRING_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+    FILTER_CLAUSE_RE = re.compile(
+        r"\b(?:where|on|order\s+by)\b(.*?)"
+        r"(?=\b(?:select|from|join|group\s+by|having|order\s+by|limit|union|intersect|except)\b|$)",
+        re.IGNORECASE | re.DOTALL,
+    )
+    GEN_OBJ_RE = re.compile(r"\bg(\d+)\.obj\b")
+    CURRENT_OBJ_RE = re.compile(r"(?<![.\w])obj\b")
+
+    # The temp tables of result columns, which set copies.
+    RESULT_TABLE_RE = re.compile(r"\btemp\.{}\b".format(ResultHistory.COLUMN_TABLE.format(r"\d+", r"\w+")))
+
+    # In a statement, the tables of generations it names, and the current
+    # generation's tables used unqualified.
+    GEN_TABLE_RE = re.compile(r"\bg(\d+)\.\w+")
+    CURRENT_TABLE_RE = re.compile(r"(?<![.\w])(obj|obj_data|ref|dom)\b", re.IGNORECASE)
+
+    # Made by the dominators command.
+    DOM_SCHEMA = [
+        "create table {schema}.dom (address int primary key, idom int, retained_size int);",
+    ]
+    DOM_INDEXES = [
+        "create index if not exists {schema}.retained on dom (retained_size);",
     ]
-    GEN_TABLES = ['obj', 'ref']
+
+    # Totals for each generation, made when it's read, and kept up to date by
+    # triggers as obj and ref change.  summary has objs, refs and bytes.
+    # type_summary has totals of objects of each type, including the
+    # references from them.
+    SUMMARY_SCHEMA = [
+        "create table {schema}.summary (name text primary key, value int);",
+        "create table {schema}.type_summary (type text primary key, count int, bytes int, len int, refs int);",
+    ]
+    SUMMARY_TRIGGERS = collections.OrderedDict([
+        ('summary_obj_insert', """AFTER INSERT ON obj BEGIN
+            UPDATE summary SET value = value + 1 WHERE name = 'objs';
+            UPDATE summary SET value = value + coalesce(new.size, 0) WHERE name = 'bytes';
+            INSERT OR IGNORE INTO type_summary (type, count, bytes, len, refs)
+                SELECT new.type, 0, 0, 0, 0 WHERE new.type IS NOT NULL;
+            UPDATE type_summary
+               SET count = count + 1,
+                   bytes = bytes + coalesce(new.size, 0),
+                   len = len + coalesce(new.len, 0),
+                   refs = refs + (SELECT count(*) FROM ref WHERE parent = new.address)
+             WHERE type = new.type;
+        END"""),
+        ('summary_obj_delete', """AFTER DELETE ON obj BEGIN
+            UPDATE summary SET value = value - 1 WHERE name = 'objs';
+            UPDATE summary SET value = value - coalesce(old.size, 0) WHERE name = 'bytes';
+            UPDATE type_summary
+               SET count = count - 1,
+                   bytes = bytes - coalesce(old.size, 0),
+                   len = len - coalesce(old.len, 0),
+                   refs = refs - (SELECT count(*) FROM ref WHERE parent = old.address)
+             WHERE type = old.type;
+        END"""),
+        ('summary_obj_update', """AFTER UPDATE OF type, size, len ON obj BEGIN
+            UPDATE summary SET value = value - coalesce(old.size, 0) + coalesce(new.size, 0) WHERE name = 'bytes';
+            UPDATE type_summary
+               SET count = count - 1,
+                   bytes = bytes - coalesce(old.size, 0),
+                   len = len - coalesce(old.len, 0),
+                   refs = refs - (SELECT count(*) FROM ref WHERE parent = old.address)
+             WHERE type = old.type;
+            INSERT OR IGNORE INTO type_summary (type, count, bytes, len, refs)
+                SELECT new.type, 0, 0, 0, 0 WHERE new.type IS NOT NULL;
+            UPDATE type_summary
+               SET count = count + 1,
+                   bytes = bytes + coalesce(new.size, 0),
+                   len = len + coalesce(new.len, 0),
+                   refs = refs + (SELECT count(*) FROM ref WHERE parent = new.address)
+             WHERE type = new.type;
+        END"""),
+        ('summary_ref_insert', """AFTER INSERT ON ref BEGIN
+            UPDATE summary SET value = value + 1 WHERE name = 'refs';
+            UPDATE type_summary SET refs = refs + 1
+             WHERE type = (SELECT type FROM obj WHERE address = new.parent);
+        END"""),
+        ('summary_ref_delete', """AFTER DELETE ON ref BEGIN
+            UPDATE summary SET value = value - 1 WHERE name = 'refs';
+            UPDATE type_summary SET refs = refs - 1
+             WHERE type = (SELECT type FROM obj WHERE address = old.parent);
+        END"""),
+    ])
+
+    # Progress of reading a data file into a generation, so an interrupted
+    # read can be resumed.  It's dropped once the generation is complete.
+    IMPORT_STATE_SCHEMA = [
+        "create table {schema}.import_state (name text primary key, value text);",
+    ]
+
+    # dom only exists once the dominators command has been run.
+    GEN_TABLES = ['obj', 'ref', 'dom']
+
+    # SQLite's default limit on attached databases.
+    MAX_ATTACHED = 10
 
     feedback = Bool(False, config=True, help="Print number of rows affected by DML")
+    parse_workers = Int(0, config=True, help="Processes used to parse a data file, 0 for one per CPU")
+    import_batch_size = Int(100000, config=True, help="Number of rows written per batch when reading a data file")
+    gc_engine = CaselessStrEnum(
+        ['csr', 'sql'], default_value='csr', config=True,
+        help="How gc marks reachable objects: in memory with NumPy (csr), or with SQL updates per depth (sql)",
+    )
+    ancestor_stop_types = List(
+        default_value=['module', 'Settings'], config=True,
+        help="Types whose referrers ancestor_types doesn't follow",
+    )
+    result_memory = Int(
+        256 * 1024 * 1024, config=True,
+        help="Bytes of displayed results kept in memory for #N references, older ones are kept in temp tables",
+    )
+    compact_schema = Bool(
+        False, config=True,
+        help="Read new generations into the compact schema, with interned types and reprs",
+    )
+    lazy_indexes = Bool(
+        False, config=True,
+        help="Only index ref when reading, and index obj's columns when a query that scans obj first uses them",
+    )
+    load_pragmas = Dict(
+        default_value={
+            'journal_mode': 'MEMORY',
+            'synchronous': 'OFF',
+            'locking_mode': 'EXCLUSIVE',
+            'cache_size': -512 * 1024,
+            'temp_store': 'MEMORY',
+        },
+        config=True,
+        help="PRAGMAs for every database while reading a data file or collecting garbage",
+    )
+    query_pragmas = Dict(
+        default_value={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'locking_mode': 'NORMAL',
+            'cache_size': -256 * 1024,
+            'mmap_size': 1024 * 1024 * 1024,
+            # Results the history spills are in temp tables, which have to
+            # be on disk to free memory.
+            'temp_store': 'FILE',
+        },
+        config=True,
+        help="PRAGMAs for every database the rest of the time",
+    )
+    backup_pages = Int(
+        16384, config=True,
+        help="Database pages copied in each step of a backup or restore, -1 for all at once",
+    )
 
     def __init__(self, *args, **kwargs):
         super(MemSeeApp, self).__init__(*args, **kwargs)
-        self.graphs = {}
+        self.query_compiler = QueryCompiler()
+        self.profiler = Profiler()
+        # The PRAGMAs in use: 'query' or 'load'.
+        self.pragma_name = 'query'
+        # Background reads, as ReadJobs.
+        self.jobs = []
+        if self.shell is not None:
+            self.shell.events.register('post_execute', self.finish_jobs)
         self.reset()
         self.debug = False
 
@@ -139,150 +404,741 @@ class MemSeeApp(SqlMagic):
     def current_gen(self):
         return self.fetchint("select num from gen where current = 1")
 
-    def _load_graph(self, gen):
-        print("Loading object graph for generation {}\n".format(gen))
+    def has_db(self):
+        """Whether there's an open database."""
+        try:
+            return bool(Connection.get(None))
+        except Exception:
+            # Some versions of ipython-sql raise if nothing is connected.
+            return False
 
-        # Store the current generation
-        current_gen = self.current_gen
+    @property
+    def raw_connection(self):
+        """The sqlite3 connection underneath ipython-sql, for bulk work."""
+        return Connection.get(None).session.connection.connection
 
-        # Activate the target generation
-        self.switch_to_generation(gen)
+    def gen_table(self, table, gen):
+        """The qualified name of generation `gen`'s `table`, attaching it if needed."""
+        self.attach_generation(gen)
+        return "{}.{}".format(self.gen_schema(gen), table)
 
-        graph = igraph.Graph(directed=True)
+    def graph_cache_prefix(self, gen):
+        return "{}.gen{}".format(self.filename, gen)
 
-        print("Loading {} objects... ".format(self.fetchint("select count(*) from obj")))
+    def heap_graph(self, gen=None):
+        """The HeapGraph of generation `gen`, or of the current generation.
 
-        start = time.time()
-        # Add all object addresses as vertex names
-        graph.add_vertices(row[0] for row in self.fetchall("select cast(address as text) from obj"))
-
-        print("Done ({} secs)\n".format(time.time() - start))
+        Graphs are kept in memory, and cached on disk next to the database,
+        until `invalidate_graph` is called for the generation.
+        """
+        if gen is None:
+            gen = self.current_gen
+        if gen not in self.heaps:
+            prefix = self.graph_cache_prefix(gen)
+            with self.profiler.phase('load graph'):
+                try:
+                    heap = HeapGraph.load(prefix)
+                except IOError:
+                    heap = HeapGraph.from_db(
+                        self.raw_connection,
+                        obj=self.gen_table('obj', gen),
+                        ref=self.gen_table('ref', gen),
+                    )
+                    heap.save(prefix)
+            self.heaps[gen] = heap
+        return self.heaps[gen]
+
+    def invalidate_graph(self, gen=None):
+        """Forget the graphs of a generation, after its obj or ref has changed."""
+        if gen is None:
+            gen = self.current_gen
+            if gen is None:
+                return
+        self.heaps.pop(gen, None)
+        self.graphs.pop(gen, None)
+        HeapGraph.remove(self.graph_cache_prefix(gen))
+
+    def invalidate_graphs(self, sql):
+        """Forget the graphs of the generations statement `sql` could have changed.
+
+        Those are the generations it names as gN, and the current one if
+        it uses its tables unqualified.  If it names neither, it could have
+        changed any of them through a view or trigger, so all are forgotten.
+        """
+        gens = set(int(gen) for gen in self.GEN_TABLE_RE.findall(sql))
+        if self.CURRENT_TABLE_RE.search(sql):
+            gens.add(self.current_gen)
+        gens.discard(None)
+        if not gens:
+            gens = [row[0] for row in self.fetchall("select num from gen")]
+        for gen in gens:
+            self.invalidate_graph(gen)
 
-        print("Loading {} edges... ".format(self.fetchint("select count(*) from ref")))
+    def _load_graph(self, gen):
+        print("Loading object graph for generation {}\n".format(gen))
 
         start = time.time()
+        heap = self.heap_graph(gen)
+        print("Loaded {} objects and {} edges ({:.1f} secs)\n".format(
+            len(heap), len(heap.parents), time.time() - start,
+        ))
 
-        # Add all of the edges
-        graph.add_edges(self.fetchall("""
-            SELECT cast(parent as text), cast(child as text)
-            FROM ref
-            INNER JOIN obj AS obj_parent ON ref.parent = obj_parent.address
-            INNER JOIN obj AS obj_child ON ref.child = obj_child.address
-        """))
-
-        print("Done ({} secs)\n".format(time.time() - start))
+        # Vertex ids are the HeapGraph's dense ids, so there are no names:
+        # heap.addresses and heap.ids translate to and from addresses.
+        start = time.time()
+        graph = igraph.Graph(n=len(heap), edges=heap.edge_pairs(), directed=True)
+        print("Built graph ({:.1f} secs)\n".format(time.time() - start))
 
         self.graphs[gen] = graph
 
-        # Switch back to the previous active generation
-        self.switch_to_generation(current_gen)
-
     def create_schema(self):
         self.execute(line='', cell='\n'.join(self.SCHEMA))
 
+    def table_exists(self, name):
+        return bool(self.fetchint("select count(*) from sqlite_master where type = 'table' and name = :name", name=name))
+
+    def gen_schema(self, gen):
+        return "g{}".format(gen)
+
+    def gen_path(self, gen):
+        """The database file holding generation `gen`."""
+        return "{}.gen{}.db".format(self.filename, gen)
+
+    def attached_generations(self):
+        """The generations attached to the connection, in the order attached."""
+        return [
+            int(name[1:])
+            for _, name, _ in self.raw_connection.execute("pragma database_list")
+            if re.match(r"g\d+$", name)
+        ]
+
+    def attach_generation(self, gen, create=False):
+        """Make generation `gen`'s tables available as gN.obj, gN.ref, and so on.
+
+        Unqualified obj and ref are the tables of the first generation
+        attached, which switch_to_generation makes the current one.
+        """
+        attached = self.attached_generations()
+        if gen in attached:
+            return
+        if gen in self.busy_generations():
+            raise MemSeeException("Generation {} is still being read, see jobs".format(gen))
+        path = self.gen_path(gen)
+        if not create and not os.path.exists(path):
+            raise MemSeeException("No data for generation {}: {}".format(gen, path))
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        if len(attached) >= self.MAX_ATTACHED:
+            current = self.current_gen
+            victim = next(other for other in attached if other != current)
+            conn.execute("detach database {}".format(self.gen_schema(victim)))
+        conn.execute("attach database ? as {}".format(self.gen_schema(gen)), (path,))
+        self.apply_pragmas(self.gen_schema(gen))
+
+    def apply_pragmas(self, *schemas):
+        """Set the PRAGMAs in use on `schemas`, or on main and every attached
+        generation.  Most of them are per database."""
+        pragmas = getattr(self, self.pragma_name + '_pragmas')
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        if not schemas:
+            schemas = ['main'] + [self.gen_schema(gen) for gen in self.attached_generations()]
+        set_pragmas(conn, schemas, pragmas)
+
+    def checkpoint(self, schema):
+        """Copy what's in `schema`'s WAL into its database file, and empty the WAL.
+
+        Does nothing to a database that isn't in WAL mode.
+        """
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("pragma {}.wal_checkpoint(TRUNCATE)".format(schema)).fetchall()
+
+    @contextlib.contextmanager
+    def pragma_profile(self, name):
+        """Use the `name` PRAGMAs ('load' or 'query') in the block."""
+        if name == self.pragma_name:
+            yield
+            return
+        previous = self.pragma_name
+        self.pragma_name = name
+        self.apply_pragmas()
+        try:
+            yield
+        finally:
+            self.pragma_name = previous
+            self.apply_pragmas()
+
+    def detach_generations(self):
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        for gen in self.attached_generations():
+            conn.execute("detach database {}".format(self.gen_schema(gen)))
+
     def switch_to_generation(self, newgen):
-        oldgen = self.current_gen
-        if oldgen is not None:
-            for table in self.GEN_TABLES:
-                self.execute_and_ignore("alter table {table} rename to {table}{gen}".format(table=table, gen=oldgen))
+        """Make `newgen` the generation in obj and ref.  This is only attaching
+        and detaching databases, no data is touched.
+
+        With no generation, obj and ref are temp views of a table that
+        doesn't exist, so using them fails, instead of finding the tables of
+        whichever generation is attached first.
+        """
+        if newgen in self.busy_generations():
+            raise MemSeeException("Generation {} is still being read, see jobs".format(newgen))
+        self.detach_generations()
         self.execute_and_ignore("update gen set current=0")
+        conn = self.raw_connection
+        for table in self.GEN_TABLES:
+            conn.execute("drop view if exists temp.{}".format(table))
         if newgen:
-            for table in self.GEN_TABLES:
-                self.execute_and_ignore("alter table {table}{gen} rename to {table}".format(table=table, gen=newgen))
             self.execute_and_ignore("update gen set current=1 where num=:gen", gen=newgen)
+            self.attach_generation(newgen)
+        else:
+            for table in self.GEN_TABLES:
+                conn.execute("create temp view {} as select * from no_current_generation".format(table))
 
-    def make_new_generation(self):
+    def make_new_generation(self, switch=True):
+        """Make a generation, and make it current unless `switch` is false."""
         gen = self.fetchint("select max(num) from gen", default=0)
         gen += 1
+        # Don't pick up data left by an earlier database of the same name.
+        self.invalidate_graph(gen)
+        remove_database(self.gen_path(gen))
         self.execute_and_ignore(
-            "insert into gen (num, current) values (:gen, 1)",
+            "insert into gen (num, current) values (:gen, 0)",
             gen=gen
         )
-        for stmt in self.GEN_SCHEMA:
-            self.execute_and_ignore(stmt.format(gen=gen))
+        if switch:
+            self.switch_to_generation(None)
+        self.attach_generation(gen, create=True)
+        # On the sqlite3 connection, since ipython-sql would split triggers
+        # at their semicolons.
+        conn = self.raw_connection
+        for stmt in self.COMPACT_GEN_SCHEMA if self.compact_schema else self.GEN_SCHEMA:
+            conn.execute(stmt.format(schema=self.gen_schema(gen)))
+        conn.commit()
+        if switch:
+            self.switch_to_generation(gen)
+        return gen
 
-    def _parse_data(self, data):
-        for line in data:
-            try:
-                objdata = ujson.loads(line)
-            except ValueError:
-                # https://bugs.launchpad.net/meliae/+bug/876810
-                objdata = ujson.loads(re.sub(r'"value": "(\\"|[^"])*"', '"value": "SURROGATE ERROR REMOVED"', line))
+    def is_compact(self, gen):
+        """Whether generation `gen` has the compact schema."""
+        return self.gen_has_table(gen, 'obj_data')
 
-            try:
-                if objdata['type'] in ('function', 'type', 'module'):
-                    objdata['repr'] = objdata.get('name', objdata.get('value', objdata['type']))
-                elif objdata['type'] in ('int', 'str', 'unicode'):
-                    objdata['repr'] = repr(objdata['value'])
+    def obj_storage(self, gen=None):
+        """The table to change objects' marks in, or delete them from, in bulk.
+
+        That's obj, except in a compact generation, where obj is a view,
+        and going through its triggers would be a statement per row.
+        """
+        if gen is None:
+            gen = self.current_gen
+        if gen is not None and self.is_compact(gen):
+            return self.gen_table('obj_data', gen)
+        return "obj"
+
+    def gen_indexes(self, gen, schema=None):
+        """(name, table, statement) of each index generation `gen` can have.
+
+        The statements are for the generation attached as `schema`, by
+        default its usual one.
+        """
+        schema = schema or self.gen_schema(gen)
+        return [
+            self.INDEX_RE.search(stmt).groups() + (stmt.format(schema=schema),)
+            for stmt in (self.COMPACT_GEN_INDEXES if self.is_compact(gen) else self.GEN_INDEXES)
+        ]
+
+    def existing_indexes(self, gen):
+        """The names of the indexes generation `gen` has, besides primary keys."""
+        self.attach_generation(gen)
+        return set(row[0] for row in self.raw_connection.execute(
+            "select name from {}.sqlite_master where type = 'index' and sql is not null".format(self.gen_schema(gen))
+        ))
+
+    def index_generation(self, gen):
+        """Make the indexes of a generation, only ref's in lazy_indexes mode."""
+        for stmt in self.import_indexes(gen):
+            self.execute_and_ignore(stmt)
+
+    def import_indexes(self, gen, schema=None):
+        """The statements making the indexes a read into `gen` makes."""
+        return [
+            stmt for name, table, stmt in self.gen_indexes(gen, schema)
+            if table == 'ref' or not self.lazy_indexes
+        ]
+
+    def make_lazy_indexes(self, sql, params):
+        """Make the obj indexes a query could use, if it scans obj without them.
+
+        Indexes are made for the obj columns the query filters, joins or
+        sorts on, in the generations whose obj it reads.
+        """
+        gens = set(int(gen) for gen in self.GEN_OBJ_RE.findall(sql))
+        if self.CURRENT_OBJ_RE.search(sql):
+            gens.add(self.current_gen)
+        gens.discard(None)
+        columns = self.filtered_columns(sql)
+        if not gens or not columns:
+            return
+        conn = self.raw_connection
+        plan = self.profiler.explain(conn, sql, params)
+        if not plan or not any(
+            m and m.group(1) != 'ref' for m in (FULL_SCAN_RE.match(detail) for detail in plan)
+        ):
+            return
+        for gen in sorted(gens):
+            existing = self.existing_indexes(gen)
+            for name, table, stmt in self.gen_indexes(gen):
+                if table != 'ref' and name in columns and name not in existing:
+                    sys.stdout.write("Indexing {} of generation {} for this query...".format(name, gen))
+                    sys.stdout.flush()
+                    start = time.time()
+                    conn.execute(stmt)
+                    print(" ({:.1f}s)".format(time.time() - start))
+
+    def filtered_columns(self, sql):
+        """The indexed obj columns in the WHERE, ON and ORDER BY clauses of `sql`."""
+        sql = self.STRING_LITERAL_RE.sub("''", sql)
+        return set(
+            column.lower()
+            for clause in self.FILTER_CLAUSE_RE.findall(sql)
+            for column in self.INDEXED_COLUMN_RE.findall(clause)
+        )
+
+    def gen_has_table(self, gen, table):
+        schema = self.gen_schema(gen)
+        self.attach_generation(gen)
+        return bool(self.fetchint(
+            "select count(*) from {}.sqlite_master where type = 'table' and name = :name".format(schema),
+            name=table,
+        ))
+
+    def create_summary_trigger(self, gen, name):
+        sql = self.SUMMARY_TRIGGERS[name]
+        if self.is_compact(gen):
+            # obj is a view, so the triggers are on obj_data, with the type
+            # looked up.  Marking objects mustn't cost a summary update.
+            sql = sql.replace(
+                "UPDATE OF type, size, len ON obj BEGIN",
+                "UPDATE OF type_id, size, len ON obj_data "
+                "WHEN old.type_id IS NOT new.type_id OR old.size IS NOT new.size OR old.len IS NOT new.len BEGIN",
+            )
+            sql = sql.replace(" ON obj BEGIN", " ON obj_data BEGIN")
+            sql = re.sub(r"\b(new|old)\.type\b", r"(SELECT name FROM types WHERE id = \1.type_id)", sql)
+        self.raw_connection.execute("create trigger {}.{} {}".format(self.gen_schema(gen), name, sql))
+
+    def write_summary(self, gen, objs, refs, bytes, types):
+        """Store a generation's totals, and start keeping them up to date.
+
+        `types` maps type names to [count, bytes, len, refs].
+        """
+        conn = self.raw_connection
+        schema = self.gen_schema(gen)
+        for name in self.SUMMARY_TRIGGERS:
+            conn.execute("drop trigger if exists {}.{}".format(schema, name))
+        conn.execute("drop table if exists {}.summary".format(schema))
+        conn.execute("drop table if exists {}.type_summary".format(schema))
+        for stmt in self.SUMMARY_SCHEMA:
+            conn.execute(stmt.format(schema=schema))
+        conn.executemany(
+            "insert into {}.summary (name, value) values (?, ?)".format(self.gen_schema(gen)),
+            [('objs', objs), ('refs', refs), ('bytes', bytes)],
+        )
+        conn.executemany(
+            "insert into {}.type_summary (type, count, bytes, len, refs) values (?, ?, ?, ?, ?)".format(self.gen_schema(gen)),
+            [[type_] + totals for type_, totals in types.items() if type_ is not None],
+        )
+        for name in self.SUMMARY_TRIGGERS:
+            self.create_summary_trigger(gen, name)
+        conn.commit()
+
+    def summarize_generation(self, gen):
+        """Build the summary of a generation read before summaries existed."""
+        obj = self.gen_table('obj', gen)
+        ref = self.gen_table('ref', gen)
+        cursor = self.raw_connection.cursor()
+        types = dict(
+            (row[0], list(row[1:]) + [0])
+            for row in cursor.execute(
+                "select type, count(*), coalesce(sum(size), 0), coalesce(sum(len), 0) from {} group by type".format(obj)
+            )
+        )
+        for type_, refs in cursor.execute(
+            "select o.type, count(*) from {} r, {} o where r.parent = o.address group by o.type".format(ref, obj)
+        ):
+            if type_ in types:
+                types[type_][3] = refs
+        objs, bytes = cursor.execute("select count(*), coalesce(sum(size), 0) from {}".format(obj)).fetchone()
+        refs = cursor.execute("select count(*) from {}".format(ref)).fetchone()[0]
+        self.write_summary(gen, objs, refs, bytes, types)
+
+    def summary_value(self, name, query):
+        """A total for the current generation, from its summary if it has one."""
+        gen = self.current_gen
+        if gen is not None and self.gen_has_table(gen, 'summary'):
+            return self.fetchint("select value from summary where name = :name", name=name)
+        return self.fetchint(query)
+
+    def migrate_generations(self):
+        """Move generations kept as objN and refN tables into their own files.
+
+        Databases made before generations had their own files kept them as
+        numbered tables in the main database, renamed on every switch.
+        """
+        if not self.fetchint("select count(*) from sqlite_master where type = 'table' and name like 'obj%'"):
+            return
+        print("Moving generations into their own database files")
+        current = self.current_gen
+        for row in self.fetchall("select num from gen order by num"):
+            gen = row[0]
+            schema = self.gen_schema(gen)
+            suffix = "" if gen == current else str(gen)
+            remove_database(self.gen_path(gen))
+            self.attach_generation(gen, create=True)
+            for stmt in self.GEN_SCHEMA:
+                self.execute_and_ignore(stmt.format(schema=schema))
+            tables = ['obj', 'ref']
+            if self.table_exists("dom" + suffix):
+                for stmt in self.DOM_SCHEMA + self.DOM_INDEXES:
+                    self.execute_and_ignore(stmt.format(schema=schema))
+                tables.append('dom')
+            for table in tables:
+                self.execute_and_ignore("insert into {schema}.{table} select * from main.{table}{suffix}".format(
+                    schema=schema, table=table, suffix=suffix,
+                ))
+                self.execute_and_ignore("drop table main.{table}{suffix}".format(table=table, suffix=suffix))
+            self.index_generation(gen)
+            self.raw_connection.execute("detach database {}".format(schema))
+            print("Moved generation {} to {}".format(gen, self.gen_path(gen)))
+        self.raw_connection.execute("vacuum")
+
+    def read_in_background(self, filename, resume=None):
+        """Start a ReadJob reading `filename` into a new generation, or
+        carrying on with the read into generation `resume`."""
+        # Fail now, not in the thread, on a file that can't be read.
+        open(filename, 'rb').close()
+        conn = self.raw_connection
+        if resume is None:
+            gen = self.start_import(filename, switch=False)
+        else:
+            gen = resume
+            if gen == self.current_gen:
+                self.switch_to_generation(None)
+        state = self.import_state(gen)
+        compact = self.is_compact(gen)
+        indexes = self.import_indexes(gen, 'main')
+        # The job's thread has its own connection to the generation.
+        if conn.in_transaction:
+            conn.commit()
+        if gen in self.attached_generations():
+            conn.execute("detach database {}".format(self.gen_schema(gen)))
+
+        def work(job):
+            return self.background_read(job, filename, state, compact, indexes, dict(self.load_pragmas))
+
+        job = ReadJob(len(self.jobs) + 1, gen, filename, work)
+        self.jobs.append(job)
+        job.start()
+        print("Reading {} into generation {} in the background, see jobs".format(filename, gen))
+
+    def background_read(self, job, filename, state, compact, indexes, pragmas):
+        """The work of a ReadJob: load the rows and make the indexes.
+
+        This runs in the job's thread, so it only uses its own connection.
+        The main thread finishes the read in finish_jobs.
+        """
+        conn = sqlite3.connect(self.gen_path(job.gen))
+        try:
+            set_pragmas(conn, ['main'], pragmas)
+            opener = gzip.open if filename.endswith(".gz") else open
+            size = os.path.getsize(filename)
+            with opener(filename, 'rb') as data:
+                # How far into the file, compressed or not, the read is.
+                raw = getattr(data, 'fileobj', data)
+
+                def on_batch(loader):
+                    job.update(loader.objs + loader.refs, loader.rows_per_sec, raw.tell() / size if size else 1)
+
+                if state['stage'] == 'loading':
+                    if state['offset']:
+                        data.seek(state['offset'])
+                    job.update(0, 0, raw.tell() / size if size else 1)
+                    stats = self.load_data(conn, 'main', data, state, compact, job.log, on_batch, pool_context())
                 else:
-                    objdata['repr'] = objdata['type']
-            except:
-                print(objdata)
-                objdata['repr'] = objdata['type']
-            yield objdata
-
-    def import_data(self, data):
-        # Put away the current generation tables.
-        self.switch_to_generation(None)
-
-        # Make a new current generation.
-        self.make_new_generation()
-
-        # Read the data.
-        print("Reading")
-
-        objs = refs = bytes = 0
-
-        sql_alch_conn = Connection.get(None).session
-
-        transaction = sql_alch_conn.begin()
-
-        for objdata in self._parse_data(data):
-
-            sql_alch_conn.execute(
-                """insert into obj
-                        (address, type, name, value, size, len, repr)
-                   values
-                        (:address, :type, :name, :value, :size, :len, :repr)
-                """,
-                address=objdata['address'],
-                type=objdata['type'],
-                name=objdata.get('name'),
-                value=objdata.get('value'),
-                size=objdata['size'],
-                len=objdata.get('len'),
-                repr=objdata['repr']
+                    stats = self.loaded_stats(state)
+            job.log("Indexing")
+            for stmt in indexes:
+                conn.execute(stmt)
+            conn.commit()
+            job.log("Loaded, finishing after the next cell runs")
+            return stats
+        finally:
+            conn.close()
+
+    def busy_generations(self):
+        """The generations background reads are writing to."""
+        return set(job.gen for job in self.jobs if job.running)
+
+    def no_jobs_running(self, action):
+        """Check that no background reads are running before `action`.
+
+        Reads that have stopped are finished first, while their database
+        is still the open one.
+        """
+        self.finish_jobs()
+        if any(not job.finished for job in self.jobs):
+            print("Wait for background reads to finish before {}, see jobs".format(action))
+            return False
+        return True
+
+    def finish_jobs(self):
+        """Finish background reads that have stopped.
+
+        This is run after each cell, since the last steps use the main
+        connection.  A finished read's generation becomes the current one.
+        """
+        for job in self.jobs:
+            if job.running or job.finished:
+                continue
+            job.finished = True
+            if job.state == 'done':
+                job.log("Finished")
+                self.switch_to_generation(job.gen)
+                self.finish_import(job.gen, job.result)
+                print("Read {} into generation {}: {.both} objects and {.both} references totalling {.both} bytes ({:.1f}s)".format(
+                    job.filename, job.gen,
+                    Num(job.result['objs']), Num(job.result['refs']), Num(job.result['bytes']),
+                    job.elapsed,
+                ))
+            elif job.state == 'cancelled':
+                print("Read of {} into generation {} cancelled, carry on with: read --resume".format(job.filename, job.gen))
+            else:
+                print("*** Read of {} into generation {} failed:\n{}".format(job.filename, job.gen, job.error))
+
+    @need_db
+    @line_magic
+    def jobs(self, line):
+        """Show background reads: jobs [wait|cancel N]
+
+        "jobs" shows each read's progress, with its rows per second and
+        an estimate of how long it has to go.  "jobs wait" waits for them
+        to finish, and "jobs cancel N" stops job N after the batch it's
+        writing, so it can be resumed later.
+        """
+        words = line.split()
+        if words == ['wait']:
+            for job in self.jobs:
+                while job.thread.is_alive():
+                    job.thread.join(0.5)
+            self.finish_jobs()
+        elif len(words) == 2 and words[0] == 'cancel':
+            for job in self.jobs:
+                if str(job.num) == words[1] and job.running:
+                    job.cancelled = True
+                    print("Cancelling job {}".format(job.num))
+                    break
+            else:
+                print("No running job {}".format(words[1]))
+        elif not words:
+            self.finish_jobs()
+            return self.display_fancy(DataFrame([job.row() for job in self.jobs]))
+        else:
+            print("Syntax:  jobs [wait|cancel N]")
+
+    def read_columnar(self, filename, path):
+        """Parse a data file straight into a columnar generation at `path`."""
+        opener = gzip.open if filename.endswith(".gz") else open
+        start = time.time()
+        writer = columnar.ColumnarWriter(path)
+        objs = refs = 0
+        workers = self.parse_workers or multiprocessing.cpu_count()
+        with opener(filename, 'rb') as data:
+            for chunk in parse_chunks(data, workers):
+                # Parsed rows have no mark.
+                writer.add('obj', [row[:6] + (None,) + row[6:] for row in chunk.obj_rows])
+                writer.add('ref', chunk.ref_rows)
+                objs += len(chunk.obj_rows)
+                refs += len(chunk.ref_rows)
+        writer.close(sorted=False, source=filename)
+        print("Wrote {.both} objects and {.both} references to {} ({:.1f}s)".format(
+            Num(objs), Num(refs), path, time.time() - start,
+        ))
+
+    def save_import_state(self, cursor, schema, **values):
+        cursor.executemany(
+            "insert or replace into {}.import_state (name, value) values (?, ?)".format(schema),
+            [(name, json.dumps(value)) for name, value in values.items()],
+        )
+
+    def import_state(self, gen):
+        """The progress saved by an unfinished read into `gen`, or None."""
+        if not self.gen_has_table(gen, 'import_state'):
+            return None
+        rows = self.raw_connection.execute("select name, value from {}.import_state".format(self.gen_schema(gen)))
+        return dict((name, json.loads(value)) for name, value in rows)
+
+    def resumable_generation(self):
+        """The newest generation, if its read was interrupted."""
+        gen = self.fetchint("select max(num) from gen")
+        if gen is None or not os.path.exists(self.gen_path(gen)) or gen in self.busy_generations():
+            return None
+        if self.import_state(gen) is None:
+            return None
+        return gen
+
+    @bulk_write
+    def import_data(self, data, filename=None, resume=None):
+        """Read the dump in `data` into a new generation.
+
+        If `resume` is a generation whose read was interrupted, the read
+        carries on into it, and `data` has to be positioned at its saved
+        offset.
+        """
+        if resume is None:
+            gen = self.start_import(filename)
+        else:
+            gen = resume
+            self.switch_to_generation(gen)
+        state = self.import_state(gen)
+
+        if state['stage'] == 'loading':
+            stats = self.load_data(self.raw_connection, self.gen_schema(gen), data, state, self.is_compact(gen))
+        else:
+            stats = self.loaded_stats(state)
+
+        # Indexes are much cheaper to build once than to maintain per row.
+        sys.stdout.write("Indexing...")
+        sys.stdout.flush()
+        start = time.time()
+        self.index_generation(gen)
+        print(" ({:.1f}s)".format(time.time() - start))
+        print("")
+
+        self.finish_import(gen, stats)
+        return stats
+
+    def start_import(self, filename, switch=True):
+        """Make a generation to read `filename` into, with its import state."""
+        gen = self.make_new_generation(switch)
+        schema = self.gen_schema(gen)
+        conn = self.raw_connection
+        for stmt in self.IMPORT_STATE_SCHEMA:
+            conn.execute(stmt.format(schema=schema))
+        self.save_import_state(conn.cursor(), schema, filename=filename, stage='loading', offset=0)
+        conn.commit()
+        return gen
+
+    def loaded_stats(self, state):
+        """The load totals saved in the import state once the rows are loaded."""
+        return dict((name, state[name]) for name in ('objs', 'refs', 'bytes', 'types'))
+
+    def finish_import(self, gen, stats):
+        """The last steps of reading into `gen`, which has to be current.
+
+        `stats` are the totals from loading the rows.
+        """
+        # These steps are safe to repeat, if they were interrupted before.
+        # The references from 0 were made by load_data.
+        sys.stdout.write("Marking top objects...")
+        sys.stdout.flush()
+        self.execute_and_ignore("INSERT OR IGNORE INTO obj (address) VALUES (0)")
+        roots = self.fetchint("select count(*) from ref where parent = 0")
+        print(" {}".format(roots))
+
+        # The root object and its references count in the totals, not by type.
+        self.write_summary(gen, stats['objs'] + 1, stats['refs'] + roots, stats['bytes'], stats['types'])
+        self.execute_and_ignore("drop table {}.import_state".format(self.gen_schema(gen)))
+
+    def load_data(self, conn, schema, data, state, compact, log=print, on_batch=None, context=multiprocessing):
+        """Load the rows of a data file, saving progress as each batch is committed.
+
+        The generation is `schema` of sqlite3 `conn`.  Messages are passed
+        to `log`, and the BulkLoader to `on_batch` after each batch.  Only
+        `conn` is used, so this can run in a background thread, with
+        `context` a multiprocessing context that can start the parsing
+        processes from one.
+        """
+        if conn.in_transaction:
+            conn.commit()
+
+        def progress(loader):
+            log("loaded {} objects, {} refs ({:.0f} rows/sec)".format(
+                loader.objs, loader.refs, loader.rows_per_sec,
+            ))
+            if on_batch:
+                on_batch(loader)
+
+        def checkpoint(cursor, loader):
+            self.save_import_state(
+                cursor, schema,
+                offset=loader.offset, objs=loader.objs, refs=loader.refs,
+                bytes=loader.bytes, types=loader.types,
+                # obj_data has no rowid, but is written with ref, so is
+                # trimmed with it.
+                obj_rowid=None if compact else cursor.execute("select max(rowid) from {}.obj".format(schema)).fetchone()[0],
+                ref_rowid=cursor.execute("select max(rowid) from {}.ref".format(schema)).fetchone()[0],
             )
-            objs += 1
-            bytes += objdata['size']
-            for ref in objdata['refs']:
-                sql_alch_conn.execute(
-                    "insert into ref (parent, child) values (:parent, :child)",
-                    parent=objdata['address'],
-                    child=ref,
+
+        loader = BulkLoader(conn, self.import_batch_size, progress, checkpoint, compact)
+        if state['offset']:
+            # Rows past the checkpoint can't have been committed, but
+            # make sure.
+            for table in ('ref',) if compact else ('obj', 'ref'):
+                conn.execute(
+                    "delete from {}.{} where rowid > ?".format(schema, table),
+                    (state['{}_rowid'.format(table)] or 0,),
                 )
-                refs += 1
-            if objs % 10000 == 0:
-                transaction.commit()
-                transaction = sql_alch_conn.begin()
-                print("loaded {} objects, {} refs".format(objs, refs))
+            conn.commit()
+            cursor = conn.cursor()
+            loader.resume(
+                state['objs'], state['refs'], state['bytes'], state['types'], state['offset'],
+                fetch_array(cursor, "select address from {}.obj".format(schema)),
+                fetch_array(cursor, "select distinct child from {}.ref".format(schema)),
+            )
+            log("Resuming at {} objects, {} refs".format(state['objs'], state['refs']))
+        else:
+            log("Reading")
 
-        self.execute_and_ignore('COMMIT')
-        print("")
+        workers = self.parse_workers or multiprocessing.cpu_count()
+        try:
+            for chunk in parse_chunks(data, workers, context=context):
+                loader.add(chunk)
+            stats = loader.finish()
+        except:
+            # Don't leave a partial batch to be committed by whatever runs next.
+            conn.rollback()
+            raise
+        log("Loaded {} rows in {:.1f}s ({:.0f} rows/sec)".format(
+            stats['objs'] + stats['refs'] - loader.start_rows, loader.elapsed, loader.rows_per_sec,
+        ))
 
-        return {'objs': objs, 'refs': refs, 'bytes': bytes}
+        # The objects nothing refers to are referred to by object 0, which
+        # is made later.  That includes 0 itself.
+        cursor = conn.cursor()
+        cursor.executemany(
+            "insert into {}.ref (parent, child) values (0, ?)".format(schema),
+            ((address,) for address in loader.roots([0]).tolist()),
+        )
+        self.save_import_state(cursor, schema, stage='loaded', **stats)
+        conn.commit()
+        return stats
 
     def execute_and_ignore(self, query, **kwargs):
-        """For running SQL that makes changes, and doesn't expect results."""
-        result = self.execute(query, local_ns=kwargs)
-        if result:
-            return len(result)
-        else:
-            return None
+        """For running SQL that makes changes, and doesn't expect results.
+
+        Returns the number of rows changed.
+        """
+        self.execute(query, local_ns=kwargs)
+        return self.raw_connection.execute("select changes()").fetchone()[0]
 
     def executemany(self, query, arglist=()):
         """Execute a SQL query many times over a list of arguments."""
-        return sum(len(self.execute(query, args)) for args in arglist)
+        return sum(self.execute_and_ignore(query, **args) for args in arglist)
 
     def fetchall(self, query, header=False, **kwargs):
         return self.execute(line=query, local_ns=kwargs)
@@ -293,21 +1149,35 @@ class MemSeeApp(SqlMagic):
             print(cell)
             if local_ns:
                 print(local_ns)
-            start = time.time()
+        if self.lazy_indexes:
+            self.make_lazy_indexes(line + cell, local_ns)
+        start = time.time()
         result = super(MemSeeApp, self).execute(line=line, cell=cell, local_ns=local_ns)
+        seconds = time.time() - start
         if self.debug:
-            print("({:.2f}s)".format(time.time() - start))
+            print("({:.2f}s)".format(seconds))
+        if self.profiler.current is not None:
+            self.profile_statement(line + cell, local_ns, result, seconds)
         return result
 
-    def fetchone(self, query, args={}):
-        result = self.fetchall(query, args)
+    def profile_statement(self, sql, params, result, seconds):
+        conn = self.raw_connection
+        if result is None:
+            rows = conn.execute("select changes()").fetchone()[0]
+        else:
+            rows = len(result)
+        plan = self.profiler.explain(conn, sql, params)
+        self.profiler.statement(sql, seconds, rows, plan)
+
+    def fetchone(self, query, **kwargs):
+        result = self.fetchall(query, **kwargs)
         if len(result) >= 1:
             return result[0]
         else:
             return None
 
-    def fetchint(self, query, args={}, default=None):
-        one = self.fetchone(query, args)
+    def fetchint(self, query, default=None, **kwargs):
+        one = self.fetchone(query, **kwargs)
         if one is None:
             return default
         if one[0] is None:
@@ -315,13 +1185,13 @@ class MemSeeApp(SqlMagic):
         return int(one[0])
 
     def num_objects(self):
-        return self.fetchint("select count(*) from obj")
+        return self.summary_value('objs', "select count(*) from obj")
 
     def num_refs(self):
-        return self.fetchint("select count(*) from ref")
+        return self.summary_value('refs', "select count(*) from ref")
 
     def total_bytes(self):
-        return self.fetchint("select sum(size) from obj")
+        return self.summary_value('bytes', "select sum(size) from obj")
 
     def define_name(self, name, value):
         self.execute_and_ignore("insert into env (name, value) values (:name, :value)", name=name, value=value)
@@ -331,8 +1201,18 @@ class MemSeeApp(SqlMagic):
 
     def reset(self):
         """Reset the db-derived state of the app."""
-        # results is a list of DataFrames
-        self.results = []
+        # results is the DataFrames displayed, numbered for #N references.
+        if getattr(self, 'results', None) is not None:
+            try:
+                self.results.clear()
+            except sqlite3.Error:
+                # The connection holding the spilled results is gone.
+                pass
+        self.results = ResultHistory(lambda: self.raw_connection, self.result_memory)
+
+        # Object graphs by generation: igraph Graphs, and HeapGraphs.
+        self.graphs = {}
+        self.heaps = {}
 
         # env is a map from names to values, rev_env is values to names.
         self.env = {}
@@ -344,6 +1224,31 @@ class MemSeeApp(SqlMagic):
         self.debug = not self.debug
         print("DEBUG MODE", "ON" if self.debug else "OFF")
 
+    @line_magic
+    def profile(self, line):
+        """Profile magics: profile [on|off|clear|statements|json PATH]
+
+        While profiling is on, each magic records its SQL statements, with
+        their times, rows and query plans, and time spent in Python.
+        "profile" shows a row per magic, "profile statements" a row per
+        statement, and "profile json PATH" writes everything to a file.
+        """
+        words = line.split()
+        if words == ["on"] or words == ["off"]:
+            self.profiler.enabled = words[0] == "on"
+            print("PROFILING", words[0].upper())
+        elif words == ["clear"]:
+            self.profiler.clear()
+        elif len(words) == 2 and words[0] == "json":
+            self.profiler.dump(words[1])
+            print("Wrote {} profiles to {}".format(len(self.profiler.invocations), words[1]))
+        elif words == ["statements"]:
+            return self.display_fancy(DataFrame(self.profiler.statement_rows()))
+        elif not words:
+            return self.display_fancy(DataFrame(self.profiler.summary()))
+        else:
+            print("Syntax:  profile [on|off|clear|statements|json PATH]")
+
     @line_magic
     def create(self, line):
         """Create a new database: create DBFILE"""
@@ -355,8 +1260,12 @@ class MemSeeApp(SqlMagic):
             self.default(line)
             return
 
+        if not self.no_jobs_running("creating a database"):
+            return
+
         self.filename = words[0]
         self.execute("sqlite:///{}".format(self.filename))
+        self.apply_pragmas()
         self.create_schema()
         self.reset()
         self.shell.push({'memsee': self})
@@ -374,9 +1283,15 @@ class MemSeeApp(SqlMagic):
             self.default(line)
             return
 
+        if not self.no_jobs_running("opening a database"):
+            return
+
         self.filename = os.path.expanduser(words[0])
         self.execute("sqlite:///{}".format(self.filename))
+        self.apply_pragmas()
         self.reset()
+        self.migrate_generations()
+        self.switch_to_generation(self.current_gen)
 
         # Load the defined names
         for name, value in self.all_names():
@@ -386,7 +1301,7 @@ class MemSeeApp(SqlMagic):
 
         print("Database opened, available via variable 'memsee'")
 
-    @need_db
+    @profiled
     @line_magic
     def read(self, line):
         """Read a data file: read DATAFILE
@@ -394,29 +1309,69 @@ class MemSeeApp(SqlMagic):
         Each file read becomes a new generation in the database.
         The last file read is the default generation, in tables obj and ref.
 
+        "read --resume [DATAFILE]" carries on with a read that was
+        interrupted, from the last batch it committed.
+
+        "read --columnar PATH DATAFILE" writes the data file as columnar
+        files in directory PATH instead (see the export command), without
+        making a generation, so it doesn't need an open database.
+
+        "read --background [--resume] DATAFILE" reads in a background
+        thread, so you can carry on querying the other generations.  The
+        jobs command shows how it's getting on, and the new generation
+        becomes the current one when it's done.
+
         """
-        if not line:
-            print("Need a file to read")
-            return
         words = line.split()
+        if words[:1] == ['--columnar']:
+            if len(words) != 3:
+                print("Syntax:  read --columnar PATH DATAFILE")
+                return
+            return self.read_columnar(words[2], words[1])
+        return self.read_generation(line)
+
+    @need_db
+    def read_generation(self, line):
+        """Read a data file into a new generation (read without --columnar)."""
+        words = line.split()
+        resume = '--resume' in words
+        if resume:
+            words.remove('--resume')
+        background = '--background' in words
+        if background:
+            words.remove('--background')
         if len(words) > 1:
             self.default(line)
             return
+
+        gen = state = None
+        if resume:
+            gen = self.resumable_generation()
+            if gen is None:
+                print("There's no interrupted read to resume")
+                return
+            state = self.import_state(gen)
+            if not words:
+                words = [state['filename']]
+
+        if not words:
+            print("Need a file to read")
+            return
         filename = words[0]
+        if background:
+            self.read_in_background(filename, resume=gen)
+            return
         if filename.endswith(".gz"):
             opener = gzip.open
         else:
             opener = open
 
         start = time.time()
-        with opener(filename) as data:
-            stats = self.import_data(data)
-
-        sys.stdout.write("Marking top objects...")
-        sys.stdout.flush()
-        self.execute_and_ignore("INSERT INTO obj (address) VALUES (0)")
-        n = self.execute_and_ignore("insert into ref (parent, child) select 0, address from obj where address not in (select child from ref);")
-        print(" {}".format(n))
+        with opener(filename, 'rb') as data:
+            if state and state['stage'] == 'loading' and state['offset']:
+                # Seeking in a gzip file has to decompress up to the offset.
+                data.seek(state['offset'])
+            stats = self.import_data(data, filename, resume=gen)
 
         end = time.time()
         print("{.both} objects and {.both} references totalling {.both} bytes ({:.1f}s)".format(
@@ -427,6 +1382,36 @@ class MemSeeApp(SqlMagic):
         ))
 
     @need_db
+    @profiled
+    @handle_errors
+    @line_magic
+    def export(self, line):
+        """Write a generation as columnar files: export GEN PATH
+
+        PATH is a directory of memory-mappable NumPy files, one or a few
+        per column of obj and ref, with types dictionary-encoded.  Open it
+        with columnar.load(PATH), which gives arrays and DataFrames.
+        """
+        words = line.split()
+        if len(words) != 2:
+            print("Syntax:  export GEN PATH")
+            return
+        try:
+            gen = int(words[0])
+        except ValueError:
+            print("** Didn't understand {!r} as a generation".format(words[0]))
+            return
+        path = os.path.expanduser(words[1])
+        start = time.time()
+        counts = columnar.export_tables(
+            self.raw_connection, self.gen_table('obj', gen), self.gen_table('ref', gen), path,
+        )
+        print("Wrote {.both} objects and {.both} references to {} ({:.1f}s)".format(
+            Num(counts['obj']), Num(counts['ref']), path, time.time() - start,
+        ))
+
+    @need_db
+    @profiled
     @line_magic
     def stats(self, line):
         """Print object and reference counts, and total size."""
@@ -437,6 +1422,108 @@ class MemSeeApp(SqlMagic):
         ))
 
     @need_db
+    @profiled
+    @handle_errors
+    @line_magic
+    def indexes(self, line):
+        """Show or change the indexes of generations: indexes [GEN] [build|drop]
+
+        "indexes" lists the indexes of every generation, and how much space
+        they take.  "indexes GEN drop" drops the obj indexes of a generation
+        you aren't querying much, and gives the space back; with
+        lazy_indexes on, they are made again when a query needs them.
+        "indexes GEN build" makes all of them.
+        """
+        words = line.split()
+        action = None
+        if words and words[-1] in ('build', 'drop'):
+            action = words.pop()
+        if len(words) > 1 or (action and not words):
+            print("Syntax:  indexes [GEN] [build|drop]")
+            return
+        if words:
+            try:
+                gens = [int(words[0])]
+            except ValueError:
+                print("** Didn't understand {!r} as a generation".format(words[0]))
+                return
+        else:
+            gens = [row[0] for row in self.fetchall("select num from gen order by num")]
+
+        conn = self.raw_connection
+        if action == 'build':
+            gen = gens[0]
+            start = time.time()
+            existing = self.existing_indexes(gen)
+            for name, table, stmt in self.gen_indexes(gen):
+                if name not in existing:
+                    conn.execute(stmt)
+            print("Built indexes of generation {} ({:.1f}s)".format(gen, time.time() - start))
+        elif action == 'drop':
+            gen = gens[0]
+            schema = self.gen_schema(gen)
+            existing = self.existing_indexes(gen)
+            self.checkpoint(schema)
+            before = os.path.getsize(self.gen_path(gen))
+            for name, table, stmt in self.gen_indexes(gen):
+                if table != 'ref' and name in existing:
+                    conn.execute("drop index {}.{}".format(schema, name))
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute("vacuum {}".format(schema))
+            # In WAL mode, the vacuumed database is in the WAL until then.
+            self.checkpoint(schema)
+            print("Dropped obj indexes of generation {}, freeing {.both} bytes".format(
+                gen, Num(before - os.path.getsize(self.gen_path(gen))),
+            ))
+        else:
+            rows = []
+            for gen in gens:
+                if not os.path.exists(self.gen_path(gen)) or gen in self.busy_generations():
+                    continue
+                existing = self.existing_indexes(gen)
+                sizes = self.index_sizes(gen)
+                for name, table, stmt in self.gen_indexes(gen):
+                    rows.append((gen, name, table, name in existing, sizes.get(name)))
+            return self.display_fancy(DataFrame(
+                rows, columns=['gen', 'index', 'table', 'built', 'bytes'], dtype=object,
+            ))
+
+    def index_sizes(self, gen):
+        """The bytes each index of a generation takes, if SQLite can tell."""
+        try:
+            return dict(self.raw_connection.execute(
+                "select name, sum(pgsize) from dbstat(?) group by name", (self.gen_schema(gen),),
+            ))
+        except sqlite3.Error:
+            # SQLite built without the dbstat table.
+            return {}
+
+    @need_db
+    @profiled
+    @handle_errors
+    @line_magic
+    def types(self, line):
+        """Show the number, size, length and references of objects by type."""
+        gen = self.current_gen
+        if gen is None:
+            raise MemSeeException("No current generation")
+        if not self.gen_has_table(gen, 'summary'):
+            print("Summarizing generation {}".format(gen))
+            self.summarize_generation(gen)
+        return self.display_fancy(self.fetchall(
+            """SELECT type, count, bytes,
+                      bytes * 1.0 / count AS avg_size,
+                      len * 1.0 / count AS avg_len,
+                      refs * 1.0 / count AS avg_refs
+                 FROM type_summary
+                WHERE count > 0
+             ORDER BY bytes DESC
+            """
+        ))
+
+    @need_db
+    @profiled
     @line_magic
     def parents(self, line):
         """Show parent objects: parents ADDRESS"""
@@ -450,6 +1537,7 @@ class MemSeeApp(SqlMagic):
             print(row)
 
     @need_db
+    @profiled
     @line_magic
     def info(self, line):
         """Show info about an object: info ADDRESS"""
@@ -462,66 +1550,47 @@ class MemSeeApp(SqlMagic):
         print(self.fetchone(query, addr=address))
 
     def substitute_symbols(self, sql):
-        """Replace tokens in `sql`."""
-        def replace_relationship(m):
-            """re.sub function for ^ and & in SQL."""
-            ref = m.group(1)
-            ops = m.group(2)
-            ref = self.substitute_symbols(ref)
-            for op in ops:
-                if ref.startswith("("):
-                    condition = "IN"
-                else:
-                    condition = "="
-                if op == "^":
-                    sql = "(select parent from ref where child {condition} {ref})"
-                else:
-                    sql = "(select child from ref where parent {condition} {ref})"
-                ref = sql.format(condition=condition, ref=ref)
-            return ref
-
-        def replace_result(m):
-            """re.sub function for #\d+.\d+ in SQL."""
-            resnum = int(m.group(1))
-            rownum = int(m.group(2))
-            try:
-                results = self.results[resnum]
-            except IndexError:
-                raise SubstitutionError("#{} doesn't name a result".format(m.group(1)))
+        """Replace tokens in `sql`.  See query.py for what they are."""
+        with self.profiler.phase('parse'):
+            query = self.query_compiler.parse(sql)
+        with self.profiler.phase('substitute'):
+            return query.render(self)
 
-            if 'address' not in results:
-                raise SubstitutionError("Results had no address column: {}".format(m.group()))
+    # Lookups of the tokens in queries, for QueryCompiler.  gen_table is
+    # the other one.
 
-            try:
-                return str(results['address'][m.group(0)])
-            except IndexError:
-                raise SubstitutionError("Result reference out of range: {}".format(m.group()))
-
-        def replace_column(m):
-            """re.sub function for #\d+.\w+ in SQL."""
-            resnum = int(m.group(1))
-            column = m.group(2)
-            try:
-                results = self.results[resnum]
-            except IndexError:
-                raise SubstitutionError("Result reference out of range: {}".format(m.group()))
-            try:
-                return "({})".format(",".join(str(value) for value in results[column]))
-            except ValueError:
-                raise SubstitutionError("No such column: {}".format(m.group()))
+    def result_row(self, resnum, label):
+        """The address in row `label` of a result, like #3.05."""
+        try:
+            results = self.results[resnum]
+        except IndexError:
+            raise SubstitutionError("#{} doesn't name a result".format(resnum))
 
-        def replace_env(m):
-            """re.sub function for $\w+ in SQL."""
-            try:
-                return self.env[m.group(1)]
-            except KeyError:
-                raise SubstitutionError("Named reference undefined: {}".format(m.group()))
+        if 'address' not in results:
+            raise SubstitutionError("Results had no address column: {}".format(label))
+
+        try:
+            return str(results['address'][label])
+        except KeyError:
+            raise SubstitutionError("Result reference out of range: {}".format(label))
 
-        sql = re.sub(r"([#$]?[\w.:]+)([&^]+)", replace_relationship, sql)
-        sql = re.sub(r"#(\d+)\.(\d+)", replace_result, sql)
-        sql = re.sub(r"#(\d+)\.(\w+)", replace_column, sql)
-        sql = re.sub(r"\$([\w.:]+)", replace_env, sql)
-        return sql
+    def result_column(self, resnum, column):
+        """A query of the values in a result column, like #3.address."""
+        try:
+            results = self.results[resnum]
+        except IndexError:
+            raise SubstitutionError("Result reference out of range: #{}.{}".format(resnum, column))
+        if column not in results:
+            raise SubstitutionError("No such column: #{}.{}".format(resnum, column))
+        table = self.results.column_table(resnum, column, self.unfix_cell)
+        return "(select value from {})".format(table)
+
+    def env_value(self, name):
+        """The value of a name defined with set."""
+        try:
+            return self.env[name]
+        except KeyError:
+            raise SubstitutionError("Named reference undefined: ${}".format(name))
 
     def fix_cell(self, c):
         """Fix cell data for good presentation."""
@@ -533,11 +1602,26 @@ class MemSeeApp(SqlMagic):
             return c
         return c
 
+    def unfix_cell(self, c):
+        """The data behind a cell fixed by fix_cell, or None for no data."""
+        if c == u"\N{RING OPERATOR}":
+            return None
+        if isinstance(c, str) and c.startswith("$") and c[1:] in self.env:
+            c = self.env[c[1:]]
+            try:
+                return int(c)
+            except ValueError:
+                return c
+        if isinstance(c, (np.integer, np.floating)):
+            return c.item()
+        return c
+
     def process_rows(self, results):
         """Process a row for output."""
         return results.applymap(self.fix_cell)
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def select(self, line):
@@ -559,7 +1643,13 @@ class MemSeeApp(SqlMagic):
             print("No results found.")
             return
 
-        num_results = len(self.results)
+        with self.profiler.phase('display'):
+            results = self.label_results(results)
+            return qgrid.show_grid(results, remote_js=True)
+
+    def label_results(self, results):
+        """Number the rows of a DataFrame #N.M, and add it to the result history."""
+        num_results = self.results.next_number()
         width = int(math.ceil(math.log10(len(results))))
         fmt_str = "#{{result}}.{{row:0>{width}}}".format(width=width)
         index = Series(fmt_str.format(result=num_results, row=row) for row in range(len(results)))
@@ -570,10 +1660,10 @@ class MemSeeApp(SqlMagic):
         results = self.process_rows(results)
 
         self.results.append(results)
-
-        return qgrid.show_grid(results, remote_js=True)
+        return results
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def insert(self, line):
@@ -582,10 +1672,21 @@ class MemSeeApp(SqlMagic):
         See the select command for available shorthands.
         """
         query = self.substitute_symbols("insert " + line)
+        # Rows inserted into a compact generation's obj view are inserted
+        # by its trigger, and SQLite doesn't count them, so count objects.
+        counted = self.obj_storage() != "obj" and re.match(
+            r"insert\s+(?:or\s+\w+\s+)?into\s+obj\b", query, re.IGNORECASE,
+        )
+        if counted:
+            before = self.num_objects()
         nrows = self.execute_and_ignore(query)
+        if counted:
+            nrows = self.num_objects() - before
+        self.invalidate_graphs(query)
         print("{} rows inserted".format(nrows))
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def delete(self, line):
@@ -594,71 +1695,223 @@ class MemSeeApp(SqlMagic):
         See the select command for available shorthands.
         """
         query = self.substitute_symbols("delete " + line)
+        obj = self.obj_storage()
+        m = re.match(r"delete\s+from\s+obj\b(.*)$", query, re.IGNORECASE | re.DOTALL)
+        if m and obj != "obj":
+            # Deleting from the view would run its trigger for every row,
+            # and SQLite doesn't count the rows.
+            query = "delete from {} where address in (select address from obj{})".format(obj, m.group(1))
         nrows = self.execute_and_ignore(query)
+        self.invalidate_graphs(query)
         print("{} rows deleted".format(nrows))
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def pin(self, condition):
         """Prevent all objects in obj selected by `condition` from being deleted by `gc`"""
         query = self.substitute_symbols('insert into ref (parent, child) select 0, address from obj where {};'.format(condition))
         nrows = self.execute_and_ignore(query)
+        self.invalidate_graph()
         print("{} rows pinned".format(nrows))
 
     @need_db
+    @profiled
+    @handle_errors
     @line_magic
-    def backup(self, _line):
-        """Copy the database for safe-keeping.  Only one level."""
-        backup = self.filename + '.bak'
-        if os.path.exists(backup):
-            print("DB already backed up")
+    def backup(self, line):
+        """Take a snapshot of the database: backup [NAME]
+
+        The database and every generation are copied with SQLite's backup
+        API, a few pages at a time, into DBFILE.snapshots/NAME.  NAME is
+        the date and time if not given.  See also restore and snapshots.
+        """
+        words = line.split()
+        if len(words) > 1:
+            print("Syntax:  backup [NAME]")
             return
-        else:
-            shutil.copyfile(self.filename, backup)
+        if not self.no_jobs_running("taking a snapshot"):
+            return
+        name = words[0] if words else time.strftime("%Y%m%d-%H%M%S")
+        store = SnapshotStore(self.filename)
+        if store.exists(name):
+            print("Snapshot {} already exists, drop it first with: snapshots drop {}".format(name, name))
+            return
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        gens = [row[0] for row in self.fetchall("select num from gen order by num")]
+        attached = dict((gen, self.gen_schema(gen)) for gen in self.attached_generations())
+        start = time.time()
+        store.take(name, conn, [gen for gen in gens if os.path.exists(self.gen_path(gen))], self.gen_path, attached, self.backup_pages)
+        print("Took snapshot {} ({:.1f}s)".format(name, time.time() - start))
 
     @need_db
+    @profiled
+    @handle_errors
     @line_magic
-    def restore(self, _line):
-        """Restore a saved-away database."""
-        backup = self.filename + '.bak'
-        if not os.path.exists(backup):
-            print("No backed up DB")
+    def restore(self, line):
+        """Go back to a snapshot of the database: restore [NAME]
+
+        Without NAME, the latest snapshot.  The data is copied back into
+        the open database, so displayed results can still be used.
+        """
+        words = line.split()
+        if len(words) > 1:
+            print("Syntax:  restore [NAME]")
+            return
+        if not self.no_jobs_running("restoring a snapshot"):
+            return
+        store = SnapshotStore(self.filename)
+        names = store.names()
+        if not names:
+            print("No snapshots")
             return
+        name = words[0] if words else names[-1]
+        if not store.exists(name):
+            print("No snapshot named {}".format(name))
+            return
+
+        start = time.time()
+        old_gens = set(row[0] for row in self.fetchall("select num from gen"))
+        self.detach_generations()
+        store.restore(name, self.raw_connection, self.gen_path, self.backup_pages)
+        gens = set(row[0] for row in self.fetchall("select num from gen"))
+        for gen in old_gens | gens:
+            self.invalidate_graph(gen)
+        for gen in old_gens - gens:
+            # Made since the snapshot.
+            remove_database(self.gen_path(gen))
+
+        self.env = {}
+        self.rev_env = {}
+        for env_name, value in self.all_names():
+            self.env[env_name] = value
+            self.rev_env[value] = env_name
+        self.switch_to_generation(self.current_gen)
+        print("Restored snapshot {} ({:.1f}s)".format(name, time.time() - start))
+
+    @need_db
+    @line_magic
+    def snapshots(self, line):
+        """List the snapshots of the database: snapshots [drop NAME]"""
+        words = line.split()
+        store = SnapshotStore(self.filename)
+        if len(words) == 2 and words[0] == "drop":
+            if not store.exists(words[1]):
+                print("No snapshot named {}".format(words[1]))
+                return
+            store.remove(words[1])
+        elif not words:
+            return self.display_fancy(DataFrame(
+                [store.info(name) for name in store.names()],
+                columns=['name', 'taken', 'gens', 'bytes'],
+            ))
         else:
-            shutil.copyfile(backup, self.filename)
-            self.open(self.filename)
+            print("Syntax:  snapshots [drop NAME]")
 
     @need_db
+    @profiled
+    @bulk_write
     @line_magic
     def gc(self, line):
         """Delete orphan objects and their references, recursively."""
         self.stats('')
-        self.execute_and_ignore("UPDATE obj SET mark = NULL WHERE mark IS NOT NULL")
-        num_marked = self.execute_and_ignore(self.substitute_symbols("UPDATE obj SET mark = 1 WHERE address IN 0&"))
+        obj = self.obj_storage()
+        self.execute_and_ignore("UPDATE {} SET mark = NULL WHERE mark IS NOT NULL".format(obj))
+        self.execute_and_ignore("UPDATE {} SET mark = 0 WHERE address = 0".format(obj))
+        num_marked = self.execute_and_ignore(self.substitute_symbols("UPDATE {} SET mark = 1 WHERE address IN 0&".format(obj)))
         print("Marked {} top level objects".format(num_marked))
         self.continue_gc(line)
 
     @need_db
+    @profiled
+    @bulk_write
     @line_magic
     def continue_gc(self, line):
         """Continue a previously interrupted garbage collection"""
+        if self.gc_engine == 'csr':
+            if not self._mark_in_memory():
+                print("Interrupted, marks so far are saved. Use continue_gc to resume.")
+                return
+        else:
+            self._mark_with_sql()
+
+        num_deleted = self.delete_unmarked()
+        print("Deleted {} objects".format(num_deleted))
+        if num_deleted:
+            self.invalidate_graph()
 
+        self.stats('')
+
+    def delete_unmarked(self):
+        """Delete the objects gc didn't mark.
+
+        The summary is adjusted with one update per type, rather than by
+        the delete trigger for every row.
+        """
+        gen = self.current_gen
+        if not self.gen_has_table(gen, 'summary'):
+            return self.execute_and_ignore("DELETE FROM {} WHERE mark IS NULL".format(self.obj_storage(gen)))
+
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        cursor = conn.cursor()
+        cursor.execute("begin")
+        try:
+            types = cursor.execute(
+                """SELECT type, count(*), coalesce(sum(size), 0), coalesce(sum(len), 0)
+                     FROM obj
+                    WHERE mark IS NULL
+                 GROUP BY type
+                """
+            ).fetchall()
+            refs = dict(cursor.execute(
+                """SELECT obj.type, count(*)
+                     FROM obj, ref
+                    WHERE ref.parent = obj.address
+                      AND obj.mark IS NULL
+                 GROUP BY obj.type
+                """
+            ).fetchall())
+            cursor.execute("drop trigger {}.summary_obj_delete".format(self.gen_schema(gen)))
+            cursor.execute("DELETE FROM {} WHERE mark IS NULL".format(self.obj_storage(gen)))
+            num_deleted = cursor.rowcount
+            self.create_summary_trigger(gen, 'summary_obj_delete')
+            cursor.executemany(
+                "UPDATE type_summary SET count = count - ?, bytes = bytes - ?, len = len - ?, refs = refs - ? WHERE type = ?",
+                [(count, bytes, len_, refs.get(type_, 0), type_) for type_, count, bytes, len_ in types],
+            )
+            cursor.executemany(
+                "UPDATE summary SET value = value - ? WHERE name = ?",
+                [(num_deleted, 'objs'), (sum(row[2] for row in types), 'bytes')],
+            )
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        return num_deleted
+
+    def _mark_with_sql(self):
+        """Mark reachable objects one depth at a time with SQL updates."""
         depth = self.fetchint("select max(mark) from obj")
+        obj = self.obj_storage()
 
         while True:
             num_marked = self.execute_and_ignore(
-                """UPDATE obj
+                """UPDATE {obj}
                       SET mark = :depth + 1
                     WHERE address IN (
                           SELECT child
-                            FROM ref, obj p, obj c
+                            FROM ref, {obj} p, {obj} c
                            WHERE ref.parent = p.address
                              AND ref.child = c.address
                              AND p.mark = :depth
                              AND c.mark is NULL
                           )
-                """,
+                """.format(obj=obj),
                 depth=depth
             )
 
@@ -669,24 +1922,224 @@ class MemSeeApp(SqlMagic):
             print("Marked {} objects at depth {}".format(num_marked, depth))
             depth += 1
 
-        num_deleted = self.execute_and_ignore("DELETE FROM obj WHERE mark IS NULL")
-        print("Deleted {} objects".format(num_deleted))
+    def _mark_in_memory(self):
+        """Mark reachable objects with a breadth-first walk over a HeapGraph.
 
-        self.stats('')
+        The existing marks are the starting point, and the new marks are
+        written back in one bulk update.  Returns False if the walk was
+        interrupted, in which case the marks made so far are still written.
+
+        """
+        conn = self.raw_connection
+        graph = self.heap_graph()
+        marks = np.full(len(graph), -1, dtype=np.int32)
+        marked = fetch_array(conn.cursor(), "select address, mark from obj where mark is not null", width=2)
+        ids, found = graph.lookup(graph.addresses, marked[:, 0])
+        marks[ids[found]] = marked[found, 1]
+        start_depth = marks.max() if len(marks) else -1
+
+        complete = True
+        try:
+            for depth, newly_marked in graph.mark_reachable(marks):
+                print("Marked {} objects at depth {}".format(len(newly_marked), depth))
+        except KeyboardInterrupt:
+            complete = False
+        else:
+            print("Marking complete")
+
+        new = np.flatnonzero(marks > start_depth)
+        cursor = conn.cursor()
+        cursor.execute("drop table if exists tmp_gc_mark")
+        cursor.execute("create temp table tmp_gc_mark (address int primary key, mark int)")
+        cursor.executemany(
+            "insert into tmp_gc_mark (address, mark) values (?, ?)",
+            zip(graph.addresses[new].tolist(), marks[new].tolist())
+        )
+        cursor.execute(
+            """UPDATE {obj}
+                  SET mark = (SELECT mark FROM tmp_gc_mark WHERE tmp_gc_mark.address = {obj}.address)
+                WHERE address IN (SELECT address FROM tmp_gc_mark)
+            """.format(obj=self.obj_storage())
+        )
+        cursor.execute("drop table tmp_gc_mark")
+        conn.commit()
+        return complete
 
     @need_db
+    @profiled
+    @handle_errors
+    @line_magic
+    def dominators(self, line):
+        """Compute the dominator tree of the current generation.
+
+        Starting from the root object 0, each reachable object gets a row in
+        the table dom (address, idom, retained_size): idom is the address of
+        its immediate dominator, and retained_size is the total size of the
+        object and everything that is only reachable through it.  Run it
+        again after changing the generation.
+        """
+        gen = self.current_gen
+        if gen is None:
+            raise MemSeeException("No current generation")
+
+        start = time.time()
+        conn = self.raw_connection
+        objs = fetch_array(conn.cursor(), "select address, coalesce(size, 0) from obj order by address", width=2)
+        graph = self.heap_graph()
+        if not np.array_equal(objs[:, 0], graph.addresses):
+            # A change the graph wasn't invalidated for.
+            self.invalidate_graph(gen)
+            graph = self.heap_graph()
+        sizes = objs[:, 1]
+        root = graph.ids([0])
+        if not len(root):
+            raise MemSeeException("No root object 0 in generation {}".format(gen))
+        indptr, indices = graph.csr
+        idom, order = heapgraph.dominators(indptr, indices, root[0])
+        retained = heapgraph.retained_sizes(idom, order, sizes)
+        print("Found dominators of {} objects ({:.1f}s)".format(len(order), time.time() - start))
+
+        dominator = idom[order]
+        idom_addresses = [
+            None if d < 0 else address
+            for d, address in zip(dominator.tolist(), graph.addresses[dominator].tolist())
+        ]
+        schema = self.gen_schema(gen)
+        cursor = conn.cursor()
+        cursor.execute("drop table if exists {}.dom".format(schema))
+        for stmt in self.DOM_SCHEMA:
+            cursor.execute(stmt.format(schema=schema))
+        cursor.executemany(
+            "insert into dom (address, idom, retained_size) values (?, ?, ?)",
+            zip(graph.addresses[order].tolist(), idom_addresses, retained[order].tolist())
+        )
+        for stmt in self.DOM_INDEXES:
+            cursor.execute(stmt.format(schema=schema))
+        conn.commit()
+
+        return self.display_fancy(self.fetchall(
+            """SELECT obj.*, dom.retained_size
+                 FROM obj, dom
+                WHERE obj.address = dom.address
+             ORDER BY dom.retained_size DESC
+                LIMIT 20
+            """
+        ))
+
+    @need_db
+    @profiled
+    @handle_errors
+    @line_magic
+    def diff(self, line):
+        """Compare two generations: diff GEN_A GEN_B
+
+        The table diff gets a row (address, status, type, old_size, new_size)
+        for each object that was added in GEN_B, removed from GEN_A, or grown
+        or shrunk between them.  The table diff_types gets the change in count and
+        bytes for each type.  Both are replaced by the next diff.
+        """
+        words = line.split()
+        gens = self.fetchint("select count(*) from gen")
+        try:
+            old_gen, new_gen = [int(word) for word in words]
+        except ValueError:
+            print("Syntax:  diff GEN_A GEN_B")
+            return
+        for gen in (old_gen, new_gen):
+            if not (0 < gen <= gens):
+                raise MemSeeException("Not a valid generation number: {}".format(gen))
+
+        start = time.time()
+        old_obj = self.gen_table('obj', old_gen)
+        new_obj = self.gen_table('obj', new_gen)
+        conn = self.raw_connection
+        cursor = conn.cursor()
+
+        # Both sides come out of the primary key in address order, so they
+        # are matched up with binary searches.
+        query = "select address, coalesce(size, 0) from {} order by address"
+        old = fetch_array(cursor, query.format(old_obj), width=2)
+        new = fetch_array(cursor, query.format(new_obj), width=2)
+        in_new, found_in_new = HeapGraph.lookup(new[:, 0], old[:, 0])
+        _, found_in_old = HeapGraph.lookup(old[:, 0], new[:, 0])
+
+        removed = old[~found_in_new]
+        added = new[~found_in_old]
+        kept_old = old[found_in_new]
+        kept_new = new[in_new[found_in_new]]
+        grown = kept_old[:, 1] < kept_new[:, 1]
+        shrunk = kept_old[:, 1] > kept_new[:, 1]
+
+        cursor.execute("drop table if exists diff")
+        cursor.execute("create table diff (address int, status text, type text, old_size int, new_size int)")
+        insert = "insert into diff (address, status, old_size, new_size) values (?, ?, ?, ?)"
+        cursor.executemany(insert, (
+            (address, 'added', None, size) for address, size in added.tolist()
+        ))
+        cursor.executemany(insert, (
+            (address, 'removed', size, None) for address, size in removed.tolist()
+        ))
+        for status, changed in (('grown', grown), ('shrunk', shrunk)):
+            cursor.executemany(insert, (
+                (address, status, old_size, new_size)
+                for address, old_size, new_size in zip(
+                    kept_new[changed, 0].tolist(), kept_old[changed, 1].tolist(), kept_new[changed, 1].tolist(),
+                )
+            ))
+        cursor.execute(
+            "update diff set type = (select type from {} o where o.address = diff.address) where status = 'removed'".format(old_obj)
+        )
+        cursor.execute(
+            "update diff set type = (select type from {} o where o.address = diff.address) where status != 'removed'".format(new_obj)
+        )
+        cursor.execute("create index diff_address on diff (address)")
+        cursor.execute("create index diff_status on diff (status)")
+        cursor.execute("create index diff_type on diff (type)")
+
+        query = "select type, count(*), coalesce(sum(size), 0) from {} group by type"
+        old_types = dict((row[0], row[1:]) for row in cursor.execute(query.format(old_obj)))
+        new_types = dict((row[0], row[1:]) for row in cursor.execute(query.format(new_obj)))
+        cursor.execute("drop table if exists diff_types")
+        cursor.execute(
+            "create table diff_types (type text, old_count int, new_count int, count_delta int, "
+            "old_bytes int, new_bytes int, bytes_delta int)"
+        )
+        type_rows = []
+        for type_ in set(old_types) | set(new_types):
+            old_count, old_bytes = old_types.get(type_, (0, 0))
+            new_count, new_bytes = new_types.get(type_, (0, 0))
+            type_rows.append((
+                type_, old_count, new_count, new_count - old_count,
+                old_bytes, new_bytes, new_bytes - old_bytes,
+            ))
+        cursor.executemany("insert into diff_types values (?, ?, ?, ?, ?, ?, ?)", type_rows)
+        conn.commit()
+
+        print("{.both} added, {.both} removed, {.both} grown, {.both} shrunk ({:.1f}s)".format(
+            Num(len(added)), Num(len(removed)), Num(int(grown.sum())), Num(int(shrunk.sum())), time.time() - start,
+        ))
+        return self.display_fancy(self.fetchall(
+            """SELECT *
+                 FROM diff_types
+                WHERE count_delta != 0 OR bytes_delta != 0
+             ORDER BY abs(bytes_delta) DESC
+            """
+        ))
+
+    @need_db
+    @profiled
+    @handle_errors
     @line_magic
     def gen(self, line):
         """Examine or switch generations.
 
-        Each data file read becomes a new generation.  The current generation
-        is available in tables obj and ref.  Other generations are in tables
-        objN and refN, where N is the generation number.
+        Each data file read becomes a new generation, kept in its own database
+        file.  The current generation is available in tables obj and ref.
+        Any generation is available as gN.obj and gN.ref, where N is the
+        generation number, and objN and refN are shorthand for those.
 
         "gen 3" will switch to generation 3, making its data available in obj
-        and ref.  At that point, obj3 and ref3 are no longer available.
-        "gen none" puts all generations into their numbered tables, and no
-        obj or ref table exists.
+        and ref.  "gen none" leaves no obj or ref table.
         """
         words = line.split()
         gens = self.fetchint("select count(*) from gen")
@@ -711,12 +2164,17 @@ class MemSeeApp(SqlMagic):
             print(msg.format(gen=gen, gens=gens))
 
     @need_db
+    @profiled
+    @handle_errors
     @line_magic
     def set(self, line):
         """Set or examine named values.
 
         "set NAME VALUE" defines a new name.  VALUE can contain other names,
-        or row numbers.
+        or row numbers.  If VALUE uses the values of a result column, like
+        #3.address, they are copied to a table named set_NAME, since results
+        don't last as long as names.  Anything else in VALUE is kept as it
+        is, so a query is run again each time the name is used.
 
         "set" prints all the defined values.
         """
@@ -729,10 +2187,38 @@ class MemSeeApp(SqlMagic):
             if len(words) != 2:
                 return self.default(line)
             name, value = words
+            value = self.store_set(name, value)
             self.env[name] = value
             self.rev_env[value] = name
             self.define_name(name, value)
 
+    def store_set(self, name, value):
+        """Copy the result columns `value` uses to tables for `name`.
+
+        Returns `value` reading those tables instead.  The first is named
+        set_NAME, any others set_NAME_2 and so on.
+        """
+        columns = []
+        for table in self.RESULT_TABLE_RE.findall(value):
+            if table not in columns:
+                columns.append(table)
+        if not columns:
+            return value
+        conn = self.raw_connection
+        if conn.in_transaction:
+            conn.commit()
+        tables = {}
+        for num, column in enumerate(columns, 1):
+            stored = "set_{}".format(name) if num == 1 else "set_{}_{}".format(name, num)
+            table = '"{}"'.format(stored.replace('"', '""'))
+            conn.execute("drop table if exists {}".format(table))
+            conn.execute("create table {} (value)".format(table))
+            conn.execute("insert into {} select value from {}".format(table, column))
+            conn.execute('create index "{}_value" on {} (value)'.format(stored.replace('"', '""'), table))
+            tables[column] = table
+        conn.commit()
+        return self.RESULT_TABLE_RE.sub(lambda m: tables[m.group(0)], value)
+
     @handle_errors
     @line_magic
     def echo(self, line):
@@ -740,132 +2226,179 @@ class MemSeeApp(SqlMagic):
         line = self.substitute_symbols(line)
         print(line)
 
+    # The objects below an object, depth-first.  Objects referenced only by
+    # their parent are expanded, shared objects are listed but not expanded.
+    KIDS_QUERY = """
+        WITH RECURSIVE kids(address, depth, refs) AS (
+            SELECT :addr, 0, (SELECT count(*) FROM ref WHERE child = :addr)
+            UNION ALL
+            SELECT ref.child, kids.depth + 1,
+                   (SELECT count(*) FROM ref r WHERE r.child = ref.child)
+              FROM kids JOIN ref ON ref.parent = kids.address
+             WHERE (kids.depth = 0 OR (kids.refs = 1 AND kids.address != :addr))
+               AND kids.depth < :depth
+             ORDER BY 2 DESC
+             LIMIT :limit
+        )
+        SELECT kids.address, kids.depth, obj.type, obj.size, obj.len, kids.refs, obj.repr
+          FROM kids LEFT JOIN obj ON obj.address = kids.address
+    """
+
+    @need_db
+    @profiled
+    @handle_errors
     @line_magic
     def kids(self, line):
-        """Display object descending from an object."""
+        """Display the objects owned by an object: kids ADDRESS [depth N] [limit N]
+
+        Children referenced only by their parent are expanded in turn, so
+        this shows the tree of objects that would be freed with ADDRESS.
+        """
         words = self.substitute_symbols(line).split()
-        if len(words) != 1:
-            print("Need an object address.")
-            return
-        id = int(words[0])
-        self.display_fancy(
-            self.fetchall(
-                "select * from obj where address = :addr",
-                addr=id
-            )
-        )
+        options = dict(zip(words[1::2], words[2::2]))
+        if len(words) % 2 != 1 or set(options) - set(['depth', 'limit']):
+            print("Syntax:  kids ADDRESS [depth N] [limit N]")
+            return
+        addr = int(words[0])
+        depth = int(options.get('depth', -1))
+        limit = int(options.get('limit', 10000))
+
+        cursor = self.raw_connection.cursor()
+        rows = cursor.execute(
+            self.KIDS_QUERY,
+            {'addr': addr, 'depth': depth if depth >= 0 else sys.maxsize, 'limit': limit},
+        ).fetchall()
+        results = self.label_results(DataFrame(
+            rows, columns=['address', 'depth', 'type', 'size', 'len', 'refs', 'repr'], dtype=object,
+        ))
 
-        ids_to_show = set([id])
-        ids_shown = set()
-        while ids_to_show:
-            ids_shown.update(ids_to_show)
-            id_list = ",".join(str(i) for i in ids_to_show)
-
-            print()
-            children = self.display_fancy("""
-                select
-                    obj.*,
-                    (select count(*) from ref where child = obj.address) refs
-                from obj
-                where address in (select child from ref where parent in ({}))
-                """.format(id_list),
-                show_headers=False,
-            )
-            child_ids = set(r[0] for r in children if r[-1] == 1)
-            ids_to_show = child_ids - ids_shown
+        gw = GridWriter(["<10", "<16", "<12", ">8", ">6", ">5", "<60"])
+        gw.header(["#", "address", "type", "size", "len", "refs", "repr"])
+        for label, raw, row in zip(results.index, rows, results.itertuples(index=False)):
+            gw.row([label, row.address, row.type, row.size, row.len, row.refs, "  " * raw[1] + str(row.repr)])
+        if len(rows) >= limit:
+            print("... stopped after {} objects".format(limit))
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def path(self, line):
-        """Find a path from one set of objects to another."""
-        words = shlex.split(self.substitute_symbols(line).encode('utf8'))
-        if (len(words) not in (4, 5)
+        """Find paths from one set of objects to another.
+
+        path from "condition1" to "condition2" [reversed] [limit N] [maxlen N]
+
+        Shows the shortest path to each object matching condition2 from
+        the nearest object matching condition1, following references from
+        parent to child, or child to parent if reversed.  At most `limit`
+        paths are shown (default 20), of at most `maxlen` references.
+        """
+        words = shlex.split(self.substitute_symbols(line))
+        options = words[4:]
+        reversed = 'reversed' in options
+        if reversed:
+            options.remove('reversed')
+        options = dict(zip(options[::2], options[1::2]))
+        if (len(words) < 4
             or words[0] != "from"
             or words[2] != "to"
-            or len(words) == 5 and words[4] != 'reversed'):
-            print('Syntax:  path from "condition1" to "condition2" [reversed]')
+            or len(words) - 4 != reversed + 2 * len(options)
+            or set(options) - set(['limit', 'maxlen'])):
+            print('Syntax:  path from "condition1" to "condition2" [reversed] [limit N] [maxlen N]')
             return
         from_cond = words[1]
         to_cond = words[3]
-        reversed = len(words) == 5
-
-        from_address = self.fetchone("SELECT cast(address as text) FROM obj WHERE {}".format(from_cond))
-        to_addresses = (row[0] for row in self.fetchall("SELECT cast(address as text) FROM obj WHERE {}".format(to_cond)))
+        limit = int(options.get('limit', 20))
+        max_length = int(options['maxlen']) if 'maxlen' in options else None
 
-        paths = self.graph.get_shortest_paths(
-            v=from_address[0],
-            to=to_addresses,
-            mode=igraph.IN if reversed else igraph.OUT,
-            output='vpath',
-        )
+        heap = self.heap_graph()
+        cursor = self.raw_connection.cursor()
+        sources = heap.ids(fetch_array(cursor, "SELECT address FROM obj WHERE {}".format(from_cond)))
+        targets = heap.ids(fetch_array(cursor, "SELECT address FROM obj WHERE {}".format(to_cond)))
 
-        for path in paths:
-            addresses = self.graph.vs.select(path)['name']
+        start = time.time()
+        paths = heap.shortest_paths(sources, targets, reversed, limit + 1, max_length)
+        print("Found {} paths ({:.1f}s)".format(min(len(paths), limit), time.time() - start))
+        if len(paths) > limit:
+            print("There are more, use limit to see them")
+            paths = paths[:limit]
+        if not paths:
+            return
 
-            self.execute_and_ignore("drop table if exists tmp_path_order")
-            self.execute_and_ignore("create temp table tmp_path_order (idx int, address int)")
-            self.executemany(
-                "insert into tmp_path_order (idx, address) values (:idx, :addr)",
-                ({"idx": idx, "addr": addr} for idx, addr in enumerate(addresses))
-            )
+        # Look up every object on every path at once.
+        addresses = [heap.addresses[path].tolist() for path in paths]
+        conn = self.raw_connection
+        conn.execute("drop table if exists temp.memsee_path_nodes")
+        conn.execute("create temp table memsee_path_nodes (address int primary key)")
+        conn.executemany(
+            "insert or ignore into temp.memsee_path_nodes (address) values (?)",
+            ((address,) for path in addresses for address in path),
+        )
+        cursor = conn.execute("select obj.* from obj join temp.memsee_path_nodes using (address)")
+        columns = [d[0] for d in cursor.description]
+        objects = dict((row[0], row) for row in cursor)
+        conn.execute("drop table temp.memsee_path_nodes")
+        conn.commit()
 
-            results = self.fetchall(
-                "select obj.* from obj, tmp_path_order where "
-                "obj.address = tmp_path_order.address order by idx"
-            )
-            if len(results):
-                self.display_fancy(results)
+        for path in addresses:
+            self.display_fancy(DataFrame(
+                [objects[address] for address in path], columns=columns, dtype=object,
+            ))
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
-    def ancestor_types(self, condition):
-        """Display the set of types in each generation of ancestors of the objects selected by `condition`"""
-        condition = self.substitute_symbols(condition)
-        self.execute_and_ignore('drop table if exists tmp_ancestor_types')
-        self.execute_and_ignore("create table tmp_ancestor_types (address int, type text, gen int, refs int, PRIMARY KEY (address, refs))")
-        gen = 0
-        inserted = self.execute_and_ignore("insert into tmp_ancestor_types select address, type, 0, 0 from obj where {}".format(condition))
-
-        while inserted > 0:
-            inserted = self.execute_and_ignore(
-                """INSERT INTO tmp_ancestor_types
-                        SELECT DISTINCT r.parent, parent.type, (:gen + 1), r.child
-                          FROM ref r LEFT OUTER JOIN tmp_ancestor_types seen
-                            ON r.parent = seen.address
-                           AND r.child = seen.refs,
-                               obj parent, tmp_ancestor_types child
-                         WHERE r.parent = parent.address
-                           AND r.child = child.address
-                           AND seen.address is NULL
-                           AND child.gen = :gen
-                           AND child.type not in ('module', 'Settings')
-                """,
-                gen=gen
-            )
-            print("Found {} new ancestors".format(inserted))
-            gen += 1
-
-        self.display_fancy(self.fetchall(
-            """SELECT gen, type, count(*)
-                 FROM (
-                     SELECT max(gen) AS gen, type
-                       FROM tmp_ancestor_types
-                   GROUP BY address
-                 )
-             GROUP BY gen, type
-             ORDER BY gen, type
-            """
-        ))
+    def ancestor_types(self, line):
+        """Display the types at each depth of ancestors of some objects.
+
+        ancestor_types CONDITION [stop TYPE,TYPE...] [depth N]
 
+        Ancestors are found breadth-first from the objects selected by
+        CONDITION, and each is counted at its shortest distance.  The
+        referrers of objects of the stop types (ancestor_stop_types by
+        default) aren't followed.
+        """
+        m = re.match(r"^(?P<cond>.*?)(?:\s+stop\s+(?P<stop>\S+))?(?:\s+depth\s+(?P<depth>\d+))?\s*$", line)
+        condition = self.substitute_symbols(m.group('cond'))
+        if not condition:
+            print("Syntax:  ancestor_types CONDITION [stop TYPE,TYPE...] [depth N]")
+            return
+        if m.group('stop') is not None:
+            stop_types = m.group('stop').split(',')
+        else:
+            stop_types = self.ancestor_stop_types
+        max_depth = int(m.group('depth')) if m.group('depth') is not None else None
+
+        heap = self.heap_graph()
+        types = Categorical([row[0] for row in self.raw_connection.execute(
+            "select type from obj order by address"
+        )])
+        if len(types) != len(heap):
+            raise MemSeeException("The object graph is out of date, try again")
+        stop = np.asarray(types.isin(stop_types))
+
+        marks = np.full(len(heap), -1, dtype=np.int32)
+        marks[heap.ids(fetch_array(self.raw_connection.cursor(), "select address from obj where {}".format(condition)))] = 0
+        for depth, found in heap.mark_ancestors(marks, stop, max_depth):
+            print("Found {} new ancestors".format(len(found)))
+
+        reached = np.flatnonzero(marks >= 0)
+        counts = DataFrame({
+            'depth': marks[reached],
+            'type': types[reached],
+        }).groupby(['depth', 'type'], observed=True).size()
+        self.display_fancy(counts.reset_index(name='count'))
 
     @need_db
+    @profiled
     @handle_errors
     @line_magic
     def shell(self, line):
         """Execute a raw sqlite command against the connected database"""
-        self.execute_and_ignore(self.substitute_symbols(line))
+        query = self.substitute_symbols(line)
+        self.execute_and_ignore(query)
+        self.invalidate_graphs(query)
 
 
 class MemSeeException(Exception):
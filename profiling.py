@@ -0,0 +1,173 @@
+"""Timing of magics, the SQL they run, and the plans SQLite picks for it."""
+
+import collections
+import contextlib
+import functools
+import json
+import re
+import time
+
+
+# EXPLAIN QUERY PLAN details that read all of obj (obj_data, in a compact
+# generation) or ref.  Older SQLite says "SCAN TABLE obj", newer "SCAN obj",
+# maybe with a schema.
+FULL_SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(?:\w+\.)?(obj|obj_data|ref)\b")
+
+# Literals in traced statements, which sqlite3 passes with the parameters
+# filled in.
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\bNULL\b")
+
+# Statements worth asking for a plan.
+PLANNABLE_RE = re.compile(r"^\s*(select|insert|update|delete|with)\b", re.IGNORECASE)
+
+
+class Invocation(object):
+    """The profile of one run of a magic."""
+    def __init__(self, magic, line):
+        self.magic = magic
+        self.line = line
+        self.start = time.time()
+        self.seconds = None
+        # Each is a dict: sql, seconds, rows, plan, full_scans.
+        self.statements = []
+        # Seconds spent in each Python phase, like 'substitute'.
+        self.phases = collections.OrderedDict()
+        # Every statement sqlite3 ran, with its literals replaced by ?, and
+        # how many times: this includes bulk work done on the connection
+        # directly.
+        self.raw_statements = collections.Counter()
+
+    def trace(self, sql):
+        """sqlite3 trace callback."""
+        if not sql.startswith("explain query plan "):
+            self.raw_statements[LITERAL_RE.sub("?", sql)] += 1
+
+    def as_dict(self):
+        return {
+            'magic': self.magic,
+            'line': self.line,
+            'start': self.start,
+            'seconds': self.seconds,
+            'statements': self.statements,
+            'phases': self.phases,
+            'raw_statements': dict(self.raw_statements),
+        }
+
+
+class Profiler(object):
+    """Collects an Invocation for each profiled magic run while enabled."""
+    def __init__(self):
+        self.enabled = False
+        self.invocations = []
+        self.current = None
+
+    def clear(self):
+        self.invocations = []
+
+    @contextlib.contextmanager
+    def invocation(self, magic, line, conn=None):
+        """Profile a magic.  Magics run by other magics are part of the outer one.
+
+        `conn` is the sqlite3 connection, whose statements are counted too.
+        """
+        if not self.enabled or self.current is not None:
+            yield
+            return
+        self.current = Invocation(magic, line)
+        if conn is not None:
+            conn.set_trace_callback(self.current.trace)
+        try:
+            yield
+        finally:
+            if conn is not None:
+                conn.set_trace_callback(None)
+            self.current.seconds = time.time() - self.current.start
+            self.invocations.append(self.current)
+            self.current = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to a phase of the current magic."""
+        if self.current is None:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            phases = self.current.phases
+            phases[name] = phases.get(name, 0) + time.time() - start
+
+    def statement(self, sql, seconds, rows, plan):
+        """Record a statement run by the current magic, with its query plan."""
+        if self.current is None:
+            return
+        self.current.statements.append({
+            'sql': sql,
+            'seconds': seconds,
+            'rows': rows,
+            'plan': plan,
+            'full_scans': sorted(set(
+                m.group(1) for m in (FULL_SCAN_RE.match(detail) for detail in plan or ()) if m
+            )),
+        })
+
+    def explain(self, conn, sql, params):
+        """The EXPLAIN QUERY PLAN details for `sql`, or None if it has none."""
+        if not PLANNABLE_RE.match(sql):
+            return None
+        try:
+            return [row[-1] for row in conn.execute("explain query plan " + sql, params or {})]
+        except Exception:
+            # Several statements, or parameters only ipython-sql understands.
+            return None
+
+    def summary(self):
+        """A row per invocation, for display."""
+        rows = []
+        for num, inv in enumerate(self.invocations):
+            sql_seconds = sum(s['seconds'] for s in inv.statements)
+            rows.append(collections.OrderedDict([
+                ('num', num),
+                ('magic', inv.magic),
+                ('line', inv.line),
+                ('seconds', inv.seconds),
+                ('sql_seconds', sql_seconds),
+                ('statements', len(inv.statements)),
+                ('raw_statements', sum(inv.raw_statements.values())),
+                ('full_scans', sum(bool(s['full_scans']) for s in inv.statements)),
+                ('phases', ", ".join("{} {:.3f}s".format(name, t) for name, t in inv.phases.items())),
+            ]))
+        return rows
+
+    def statement_rows(self):
+        """A row per statement of every invocation, for display."""
+        rows = []
+        for num, inv in enumerate(self.invocations):
+            for s in inv.statements:
+                rows.append(collections.OrderedDict([
+                    ('num', num),
+                    ('magic', inv.magic),
+                    ('seconds', s['seconds']),
+                    ('rows', s['rows']),
+                    ('full_scans', ",".join(s['full_scans'])),
+                    ('sql', " ".join(s['sql'].split())),
+                    ('plan', "; ".join(s['plan'] or ())),
+                ]))
+        return rows
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump([inv.as_dict() for inv in self.invocations], f, indent=2, default=str)
+
+
+def profiled(fn):
+    """Decorator for magics, to profile them when profiling is on."""
+    @functools.wraps(fn)
+    def _dec(self, *args, **kwargs):
+        line = args[0] if args else kwargs.get('line', '')
+        # Some magics, like read --columnar, don't need a database.
+        conn = self.raw_connection if self.profiler.enabled and self.has_db() else None
+        with self.profiler.invocation(fn.__name__, line, conn):
+            return fn(self, *args, **kwargs)
+    return _dec
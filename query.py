@@ -0,0 +1,140 @@
+"""Compiling memsee's shorthands in queries into SQL.
+
+A query can use:
+
+    #N.M        the address in row M of result N
+    #N.column   the values in a column of result N
+    $name       a defined name
+    objN, refN, domN
+                the tables of generation N
+    X^, X&      the parents or children of X, repeated for X^^, X&&& etc.
+
+Single-quoted SQL strings are left alone.  Queries are parsed once, and
+the parsed form is cached by text; the shorthands are looked up each time
+the query is rendered, since their values change.
+
+"""
+
+import collections
+import re
+
+
+TOKEN_RE = re.compile(r"""
+    (?P<string>'(?:[^']|'')*'?)
+    | (?P<base>[#$]?[\w.:]+)(?P<ops>[&^]+)
+    | \#(?P<row_result>\d+)\.(?P<row>\d+)
+    | \#(?P<col_result>\d+)\.(?P<column>\w+)
+    | \$(?P<name>[\w.:]+)
+    | \b(?P<table>obj|ref|dom)(?P<gen>\d+)\b
+""", re.VERBOSE)
+
+
+class Relationship(object):
+    """X followed by a run of ^ (parents) or & (children)."""
+    STEP = {
+        '^': ("parent", "child"),
+        '&': ("child", "parent"),
+    }
+
+    def __init__(self, base, op, count):
+        self.base = base
+        self.op = op
+        self.count = count
+
+    def render(self, symbols):
+        base = self.base.render(symbols)
+        condition = "IN" if base.startswith("(") else "="
+        wanted, given = self.STEP[self.op]
+        if self.count == 1:
+            return "(select {wanted} from ref where {given} {condition} {base})".format(
+                wanted=wanted, given=given, condition=condition, base=base,
+            )
+        # A run of the same step is one recursive query, instead of a
+        # subquery nested in a subquery for each step.
+        return (
+            "(with recursive chain(address, depth) as ("
+            "select {wanted}, 1 from ref where {given} {condition} {base} "
+            "union "
+            "select ref.{wanted}, chain.depth + 1 from chain join ref on ref.{given} = chain.address "
+            "where chain.depth < {count}"
+            ") select address from chain where depth = {count})"
+        ).format(wanted=wanted, given=given, condition=condition, base=base, count=self.count)
+
+
+class Symbol(object):
+    """A shorthand looked up with a method of the symbols object."""
+    def __init__(self, method, *args):
+        self.method = method
+        self.args = args
+
+    def render(self, symbols):
+        return getattr(symbols, self.method)(*self.args)
+
+
+class Query(object):
+    """A parsed query: SQL text, with shorthands to fill in."""
+    def __init__(self, parts):
+        self.parts = parts
+
+    def render(self, symbols):
+        """Produce SQL, looking up shorthands with methods of `symbols`.
+
+        `symbols` needs result_row(num, label), result_column(num, column),
+        env_value(name) and gen_table(table, gen), each returning SQL text.
+
+        """
+        return "".join(
+            part.render(symbols) if hasattr(part, 'render') else part
+            for part in self.parts
+        )
+
+
+def parse(text):
+    """Parse the memsee query `text` into a Query."""
+    parts = []
+    pos = 0
+    for m in TOKEN_RE.finditer(text):
+        if m.group('string') is not None:
+            continue
+        parts.append(text[pos:m.start()])
+        pos = m.end()
+        if m.group('ops') is not None:
+            node = parse(m.group('base'))
+            ops = m.group('ops')
+            start = 0
+            for i in range(1, len(ops) + 1):
+                if i == len(ops) or ops[i] != ops[start]:
+                    node = Relationship(node, ops[start], i - start)
+                    start = i
+            parts.append(node)
+        elif m.group('row') is not None:
+            parts.append(Symbol('result_row', int(m.group('row_result')), m.group(0)))
+        elif m.group('column') is not None:
+            parts.append(Symbol('result_column', int(m.group('col_result')), m.group('column')))
+        elif m.group('name') is not None:
+            parts.append(Symbol('env_value', m.group('name')))
+        else:
+            parts.append(Symbol('gen_table', m.group('table'), int(m.group('gen'))))
+    parts.append(text[pos:])
+    return Query([part for part in parts if part != ""])
+
+
+class QueryCompiler(object):
+    """Parse queries, keeping the most recent `size` in a cache."""
+    def __init__(self, size=256):
+        self.size = size
+        self.cache = collections.OrderedDict()
+
+    def parse(self, text):
+        try:
+            query = self.cache.pop(text)
+        except KeyError:
+            query = parse(text)
+            if len(self.cache) >= self.size:
+                self.cache.popitem(last=False)
+        self.cache[text] = query
+        return query
+
+    def compile(self, text, symbols):
+        """The SQL for `text`, with shorthands looked up from `symbols`."""
+        return self.parse(text).render(symbols)
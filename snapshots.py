@@ -0,0 +1,132 @@
+"""Named snapshots of a memsee database, taken with SQLite's backup API.
+
+The snapshots of DBFILE are in DBFILE.snapshots, a directory per snapshot
+holding a copy of the main database, main.db, and of each generation's
+file, genN.db.  The backup API copies a database a number of pages at a
+time, so it doesn't hold a lock for the whole copy, and restarts if the
+database changes under it, so a copy is never of a half-written state.
+
+"""
+
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+
+
+def copy_database(source, target, name='main', pages=-1, label=None):
+    """Copy database `name` of sqlite3 connection `source` into `target`'s main.
+
+    `pages` is how many pages are copied in each step, -1 for all at once.
+    If `label` is given, progress is printed with it.
+    """
+    def progress(status, remaining, total):
+        if label and total:
+            sys.stdout.write("\r{}: {:.0f}% of {} pages".format(label, 100.0 * (total - remaining) / total, total))
+            sys.stdout.flush()
+
+    source.backup(target, pages=pages, progress=progress, name=name)
+    if label:
+        sys.stdout.write("\n")
+
+
+class SnapshotStore(object):
+    """The snapshots of the database in `filename`."""
+    def __init__(self, filename):
+        self.directory = filename + ".snapshots"
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        return os.path.isdir(self.path(name))
+
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            (name for name in os.listdir(self.directory) if not name.endswith(".tmp")),
+            key=lambda name: os.path.getmtime(self.path(name)),
+        )
+
+    def main_file(self, name):
+        return os.path.join(self.path(name), "main.db")
+
+    def gen_file(self, name, gen):
+        return os.path.join(self.path(name), "gen{}.db".format(gen))
+
+    def gens(self, name):
+        """The generations with files in snapshot `name`."""
+        return sorted(
+            int(m.group(1))
+            for m in (re.match(r"gen(\d+)\.db$", f) for f in os.listdir(self.path(name)))
+            if m
+        )
+
+    def info(self, name):
+        """When snapshot `name` was taken, its generations, and its size in bytes."""
+        path = self.path(name)
+        return {
+            'name': name,
+            'taken': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path))),
+            'gens': len(self.gens(name)),
+            'bytes': sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)),
+        }
+
+    def take(self, name, conn, gens, gen_path, attached, pages=-1):
+        """Take snapshot `name` from sqlite3 connection `conn`.
+
+        `gens` are the generations to copy, with `gen_path(gen)` their
+        files.  Generations in `attached`, a map to their schema names, are
+        copied through `conn`, the others from their files.
+        """
+        final = self.path(name)
+        tmp = final + ".tmp"
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        copies = [(os.path.join(tmp, "main.db"), None, "main", "main")]
+        for gen in gens:
+            copies.append((
+                os.path.join(tmp, "gen{}.db".format(gen)),
+                None if gen in attached else gen_path(gen),
+                attached.get(gen, "main"),
+                "gen {}".format(gen),
+            ))
+        for target_file, source_file, schema, label in copies:
+            source = sqlite3.connect(source_file) if source_file else conn
+            target = sqlite3.connect(target_file)
+            try:
+                copy_database(source, target, schema, pages, label)
+            finally:
+                target.close()
+                if source_file:
+                    source.close()
+        # Only a complete snapshot gets its name.
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(tmp, final)
+
+    def restore(self, name, conn, gen_path, pages=-1):
+        """Copy snapshot `name` back into `conn`'s main database and the generation files.
+
+        The generations must not be attached to `conn`.
+        """
+        source = sqlite3.connect(self.main_file(name))
+        try:
+            copy_database(source, conn, "main", pages, "main")
+        finally:
+            source.close()
+        for gen in self.gens(name):
+            source = sqlite3.connect(self.gen_file(name, gen))
+            target = sqlite3.connect(gen_path(gen))
+            try:
+                copy_database(source, target, "main", pages, "gen {}".format(gen))
+            finally:
+                source.close()
+                target.close()
+
+    def remove(self, name):
+        shutil.rmtree(self.path(name))
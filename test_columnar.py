@@ -0,0 +1,50 @@
+"""Tests of columnar generations."""
+
+import numpy as np
+
+import columnar
+
+
+OBJ_ROWS = [
+    (16, 'dict', None, None, 232, 3, None, 'dict'),
+    (32, 'str', None, u'caf\xe9', 53, 4, 1, u"'caf\\xe9'"),
+    (48, 'dict', u'n', u'', None, None, None, 'dict'),
+]
+
+
+def test_round_trip(tmpdir):
+    path = str(tmpdir.join("gen"))
+    writer = columnar.ColumnarWriter(path)
+    writer.add('obj', OBJ_ROWS)
+    writer.add('ref', [(16, 32), (16, 48)])
+    writer.close()
+
+    gen = columnar.load(path)
+    assert len(gen) == 3
+    assert gen.column('obj', 'address').tolist() == [16, 32, 48]
+    assert list(gen.column('obj', 'type')) == ['dict', 'str', 'dict']
+    assert gen.column('obj', 'value').tolist() == [None, u'caf\xe9', u'']
+    assert gen.valid('obj', 'size').tolist() == [True, True, False]
+    assert gen.column('ref', 'child').tolist() == [32, 48]
+    frame = gen.frame('obj')
+    assert frame['name'].tolist() == [None, None, u'n']
+    assert np.isnan(frame['mark'][0]) and frame['mark'][1] == 1
+
+
+def test_empty_tables(tmpdir):
+    path = str(tmpdir.join("gen"))
+    writer = columnar.ColumnarWriter(path)
+    writer.add('obj', OBJ_ROWS[:1])
+    writer.close()
+
+    gen = columnar.load(path)
+    assert gen.column('ref', 'parent').tolist() == []
+    assert len(gen.frame('ref')) == 0
+    assert list(gen.frame('ref').columns) == ['parent', 'child']
+
+    writer = columnar.ColumnarWriter(path)
+    writer.close()
+    gen = columnar.load(path)
+    assert len(gen) == 0
+    assert len(gen.frame('obj')) == 0
+    assert len(gen.column('obj', 'type')) == 0
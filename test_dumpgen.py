@@ -0,0 +1,20 @@
+"""Tests of the synthetic dump generator."""
+
+import json
+
+import pytest
+
+from dumpgen import DumpGenerator
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_dump_has_top_objects(seed):
+    # Lots of references back, which used to refer to the only root.
+    generator = DumpGenerator(objects=3000, cycles=0.05, seed=seed)
+    addresses = set()
+    children = set()
+    for line in generator.lines():
+        data = json.loads(line.decode('ascii'))
+        addresses.add(data['address'])
+        children.update(data['refs'])
+    assert addresses - children
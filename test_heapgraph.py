@@ -0,0 +1,60 @@
+"""Tests of the graph algorithms in heapgraph."""
+
+import numpy as np
+import pytest
+
+import heapgraph
+
+
+def reachable(indptr, indices, root, removed=None):
+    """The vertices reachable from `root` without going through `removed`."""
+    seen = set([root])
+    stack = [root]
+    while stack:
+        v = stack.pop()
+        for w in indices[indptr[v]:indptr[v + 1]].tolist():
+            if w != removed and w not in seen:
+                seen.add(w)
+                stack.append(w)
+    return seen
+
+
+def brute_force_idom(indptr, indices, root, num_vertices):
+    """Immediate dominators from the definition: d dominates v if v can't
+    be reached without d.  The immediate one is the dominator of v that
+    all its other dominators dominate, so has the most dominators."""
+    reached = reachable(indptr, indices, root)
+    dominated = dict(
+        (d, reached - reachable(indptr, indices, root, removed=d)) for d in reached if d != root
+    )
+    dominated[root] = reached
+    dominators = dict((v, [d for d in reached if v in dominated[d] and d != v]) for v in reached)
+    idom = np.full(num_vertices, -1, dtype=np.int64)
+    for v in reached:
+        if v != root:
+            idom[v] = max(dominators[v], key=lambda d: len(dominators[d]))
+    return idom
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_dominators_match_brute_force(seed):
+    rng = np.random.RandomState(seed)
+    num_vertices = rng.randint(2, 40)
+    num_edges = rng.randint(0, 3 * num_vertices)
+    sources = rng.randint(0, num_vertices, num_edges)
+    targets = rng.randint(0, num_vertices, num_edges)
+    indptr, indices = heapgraph.to_csr(sources, targets, num_vertices)
+
+    idom, order = heapgraph.dominators(indptr, indices, 0)
+
+    assert sorted(order.tolist()) == sorted(reachable(indptr, indices, 0))
+    assert idom.tolist() == brute_force_idom(indptr, indices, 0, num_vertices).tolist()
+
+
+def test_retained_sizes():
+    # 0 -> 1 -> 2, 0 -> 3 -> 2: 2 is only dominated by 0.
+    indptr, indices = heapgraph.to_csr(np.array([0, 1, 0, 3]), np.array([1, 2, 3, 2]), 5)
+    idom, order = heapgraph.dominators(indptr, indices, 0)
+    assert idom.tolist() == [-1, 0, 0, 0, -1]
+    retained = heapgraph.retained_sizes(idom, order, np.array([1, 10, 100, 1000, 10000]))
+    assert retained.tolist() == [1111, 10, 100, 1000, 0]
@@ -0,0 +1,107 @@
+"""Tests of the memsee magics, in a plain IPython shell."""
+
+import os
+
+import pytest
+
+pytest.importorskip('sql.magic')
+
+from dumpgen import DumpGenerator
+
+
+@pytest.fixture
+def shell():
+    from IPython.core.interactiveshell import InteractiveShell
+    from sql.magic import load_ipython_extension as sql_load_ipython_extension
+
+    shell = InteractiveShell.instance()
+    sql_load_ipython_extension(shell)
+    return shell
+
+
+@pytest.fixture
+def dump(tmpdir):
+    filename = str(tmpdir.join("dump.json"))
+    DumpGenerator(objects=5000).write(filename)
+    return filename
+
+
+def make_app(shell, tmpdir, **config):
+    """A MemSeeApp with a new database, configured with `config`."""
+    import memsee
+
+    app = memsee.MemSeeApp(shell=shell)
+    for name, value in config.items():
+        setattr(app, name, value)
+    shell.register_magics(app)
+    shell.run_line_magic('create', str(tmpdir.join("test.db")))
+    return app
+
+
+def obj_indexes(app, gen):
+    return set(
+        name for name, table, stmt in app.gen_indexes(gen)
+        if table != 'ref' and name in app.existing_indexes(gen)
+    )
+
+
+def test_lazy_indexes_not_made_for_projections(shell, tmpdir, dump):
+    app = make_app(shell, tmpdir, lazy_indexes=True)
+    shell.run_line_magic('read', dump)
+    assert obj_indexes(app, 1) == set()
+
+    shell.run_line_magic('select', "name, value, repr, size from obj limit 3")
+    shell.run_line_magic('select', "address from obj where repr = 'size' limit 3")
+    assert obj_indexes(app, 1) == set(['repr'])
+
+    shell.run_line_magic('select', "address from obj where size > 100 order by type limit 3")
+    assert obj_indexes(app, 1) == set(['repr', 'size', 'type'])
+
+
+def test_dropping_indexes_shrinks_the_file(shell, tmpdir, dump):
+    app = make_app(shell, tmpdir)
+    shell.run_line_magic('read', dump)
+    app.checkpoint('g1')
+    before = os.path.getsize(app.gen_path(1))
+
+    shell.run_line_magic('indexes', "1 drop")
+    assert obj_indexes(app, 1) == set()
+    # The vacuumed database is in the file, not left in the WAL.
+    assert not os.path.exists(app.gen_path(1) + "-wal") or os.path.getsize(app.gen_path(1) + "-wal") == 0
+    assert os.path.getsize(app.gen_path(1)) < before
+
+
+def test_spilled_results_are_on_disk(shell, tmpdir, dump):
+    app = make_app(shell, tmpdir)
+    shell.run_line_magic('read', dump)
+    # 1 is FILE: the history's temp tables don't stay in memory.
+    assert app.raw_connection.execute("pragma temp_store").fetchone()[0] == 1
+    shell.run_line_magic('gc', '')
+    assert app.raw_connection.execute("pragma temp_store").fetchone()[0] == 1
+
+
+def test_gen_leaves_current_generation_while_busy(shell, tmpdir, dump):
+    import threading
+    from jobs import JobCancelled, ReadJob
+
+    app = make_app(shell, tmpdir)
+    shell.run_line_magic('read', dump)
+    shell.run_line_magic('read', dump)
+    # A read into generation 1 that runs until it's let go.
+    release = threading.Event()
+
+    def work(job):
+        release.wait()
+        raise JobCancelled()
+
+    job = ReadJob(1, 1, dump, work)
+    app.jobs.append(job)
+    job.start()
+    try:
+        shell.run_line_magic('gen', '1')
+        assert app.current_gen == 2
+        assert app.attached_generations() == [2]
+        assert app.num_objects() == app.fetchint("select count(*) from obj")
+    finally:
+        release.set()
+        job.thread.join()